@@ -0,0 +1,315 @@
+"""Memory-mapped arena that holds LatentAligner state for every session, shared by all workers."""
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+try:  # 跨进程的槽位锁依赖 POSIX 记录锁；没有时退化为进程内锁
+    import fcntl
+except ImportError:  # pragma: no cover - 非 POSIX 平台
+    fcntl = None
+
+from latent_aligner import LatentAligner
+
+_MAGIC = b"LAARENA1"
+# magic, D, k_max, n_slots, slot_size, dtype 字符串
+_FILE_HEADER = struct.Struct("<8sqqqq16s")
+_FILE_HEADER_SIZE = 4096
+_ID_BYTES = 64
+_SLOT_HEADER_SIZE = 128  # session_id (64B) + 占用标记，补齐到 128B
+_META_LEN = 4            # [k, version, has_pending, 保留]
+_ALIGN = 64
+
+SLOT_FREE = 0
+SLOT_USED = 1
+
+
+def _align(n: int) -> int:
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class AlignerArena:
+    """
+    所有会话的对齐器状态放在同一个 mmap 文件里：
+    - 文件头记录 D / k_max / 槽位数 / dtype，打开时校验
+    - 每个会话一个固定大小槽位：session_id、[k, version, has_pending]、
+      B (D x k_max)、A (k_max x k_max)、b、θ、grad_residual、pending action
+    - session_id 通过稳定哈希 + 线性探测定位槽位，不需要额外的目录进程
+    - 每个槽位一把锁（进程内 threading.Lock + 文件字节区间的 fcntl 记录锁），
+      任何 worker 都能零拷贝地读写任意会话，分析进程也可以直接只读映射
+    - 状态写在共享映射里，worker 崩溃后重启即可接着用
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        D: int,
+        k_max: int,
+        n_slots: int = 4096,
+        dtype=np.float64,
+        readonly: bool = False,
+    ) -> None:
+        self.path = Path(path)
+        self.dtype = np.dtype(dtype)
+        self.readonly = readonly
+
+        self.D, self.k_max, self.n_slots = D, k_max, n_slots
+        self._layout, self.slot_size = self._build_layout(D, k_max, self.dtype)
+
+        if not readonly:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        # fcntl 记录锁不在同一进程的线程之间互斥，文件头锁外面再套一把进程内的锁
+        self._header_lock = threading.Lock()
+        flags = os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT
+        self._fd = os.open(str(self.path), flags, 0o644)
+        with self._global_lock():
+            self._init_or_check_header()
+        self._mm = mmap.mmap(
+            self._fd,
+            _FILE_HEADER_SIZE + n_slots * self.slot_size,
+            access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE,
+        )
+        self._thread_locks: Dict[int, threading.RLock] = {}
+        self._thread_locks_guard = threading.Lock()
+        # 槽位 -> 当前持有线程的嵌套层数；只有持有该槽位 RLock 的线程会读写对应项
+        self._lock_depth: Dict[int, int] = {}
+
+    @classmethod
+    def open(cls, path: Union[str, Path], readonly: bool = True) -> "AlignerArena":
+        """按文件头里记录的参数打开已有 arena（分析进程用）。"""
+        with open(path, "rb") as fh:
+            magic, D, k_max, n_slots, _, dtype = _FILE_HEADER.unpack(fh.read(_FILE_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError(f"{path} 不是对齐器 arena 文件")
+        return cls(path, D, k_max, n_slots, np.dtype(dtype.rstrip(b"\0").decode()), readonly=readonly)
+
+    @staticmethod
+    def _build_layout(D: int, k_max: int, dtype: np.dtype) -> Tuple[Dict[str, Tuple[int, Tuple[int, ...], np.dtype]], int]:
+        fields = [
+            ("_meta", (_META_LEN,), np.dtype(np.int64)),
+            ("_B_buf", (D, k_max), dtype),
+            ("_A_buf", (k_max, k_max), dtype),
+            ("_b_buf", (k_max,), dtype),
+            ("_theta_buf", (k_max,), dtype),
+            ("grad_residual", (D,), dtype),
+            ("pending", (D,), dtype),
+        ]
+        layout = {}
+        offset = _SLOT_HEADER_SIZE
+        for name, shape, dt in fields:
+            layout[name] = (offset, shape, dt)
+            offset = _align(offset + int(np.prod(shape)) * dt.itemsize)
+        return layout, offset
+
+    def _init_or_check_header(self) -> None:
+        expected = _FILE_HEADER.pack(
+            _MAGIC, self.D, self.k_max, self.n_slots, self.slot_size, self.dtype.str.encode()
+        )
+        size = os.fstat(self._fd).st_size
+        if size == 0 and not self.readonly:
+            # 稀疏文件：只有真正写过的槽位才占磁盘
+            os.ftruncate(self._fd, _FILE_HEADER_SIZE + self.n_slots * self.slot_size)
+            os.pwrite(self._fd, expected, 0)
+            return
+        current = os.pread(self._fd, _FILE_HEADER.size, 0)
+        if current != expected:
+            raise ValueError(
+                f"{self.path} 的布局与当前配置不一致（D={self.D}, k_max={self.k_max}, "
+                f"n_slots={self.n_slots}, dtype={self.dtype}）"
+            )
+
+    # ----------------------------- 锁 ---------------------------------
+    def _slot_offset(self, slot: int) -> int:
+        return _FILE_HEADER_SIZE + slot * self.slot_size
+
+    @contextmanager
+    def _record_lock(self, start: int, length: int) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        mode = fcntl.LOCK_SH if self.readonly else fcntl.LOCK_EX
+        fcntl.lockf(self._fd, mode, length, start, os.SEEK_SET)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start, os.SEEK_SET)
+
+    @contextmanager
+    def _global_lock(self) -> Iterator[None]:
+        """文件头区间的锁，用于分配 / 释放槽位；不可重入。"""
+        with self._header_lock:
+            with self._record_lock(0, _FILE_HEADER_SIZE):
+                yield
+
+    @contextmanager
+    def lock(self, slot: int) -> Iterator[None]:
+        """
+        槽位锁：同进程的线程和其他 worker 进程都会被挡住。
+        同一线程可以嵌套；fcntl 记录锁不计数，一次 LOCK_UN 就会整段释放，
+        所以只在最外层加锁和解锁
+        """
+        with self._thread_locks_guard:
+            tlock = self._thread_locks.setdefault(slot, threading.RLock())
+        with tlock:
+            depth = self._lock_depth.get(slot, 0)
+            self._lock_depth[slot] = depth + 1
+            try:
+                if depth:
+                    yield
+                else:
+                    with self._record_lock(self._slot_offset(slot), self.slot_size):
+                        yield
+            finally:
+                self._lock_depth[slot] = depth
+
+    # ----------------------------- 槽位 ---------------------------------
+    def _header_view(self, slot: int) -> Tuple[memoryview, np.ndarray]:
+        off = self._slot_offset(slot)
+        id_view = memoryview(self._mm)[off : off + _ID_BYTES]
+        state = np.ndarray((1,), dtype=np.int64, buffer=self._mm, offset=off + _ID_BYTES)
+        return id_view, state
+
+    def _probe(self, session_id: str) -> Iterator[int]:
+        start = zlib.crc32(session_id.encode("utf-8")) % self.n_slots
+        for i in range(self.n_slots):
+            yield (start + i) % self.n_slots
+
+    @staticmethod
+    def _encode_id(session_id: str) -> bytes:
+        raw = session_id.encode("utf-8")
+        if len(raw) > _ID_BYTES:
+            raise ValueError(f"session_id 超过 {_ID_BYTES} 字节: {session_id!r}")
+        return raw.ljust(_ID_BYTES, b"\0")
+
+    def find(self, session_id: str) -> Optional[int]:
+        """session_id 所在槽位；不存在时返回 None（超长、不可能存过的 id 也一样，不抛异常）。"""
+        try:
+            key = self._encode_id(session_id)
+        except ValueError:
+            return None
+        for slot in self._probe(session_id):
+            id_view, state = self._header_view(slot)
+            if state[0] == SLOT_FREE and bytes(id_view) == b"\0" * _ID_BYTES:
+                return None  # 从未用过的槽位，探测链到此结束
+            if state[0] == SLOT_USED and bytes(id_view) == key:
+                return slot
+        return None
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.find(session_id) is not None
+
+    def acquire(self, session_id: str) -> Tuple[int, bool]:
+        """找到或分配 session_id 的槽位，返回 (槽位号, 是否新分配)。"""
+        slot = self.find(session_id)
+        if slot is not None:
+            return slot, False
+        if self.readonly:
+            raise KeyError(session_id)
+        key = self._encode_id(session_id)
+        with self._global_lock():
+            slot = self.find(session_id)  # 拿到锁后再查一次，防止其他 worker 刚分配
+            if slot is not None:
+                return slot, False
+            for slot in self._probe(session_id):
+                id_view, state = self._header_view(slot)
+                if state[0] != SLOT_USED:
+                    id_view[:] = key
+                    state[0] = SLOT_USED
+                    return slot, True
+        raise RuntimeError(f"arena 已满（{self.n_slots} 个槽位）")
+
+    def release(self, session_id: str) -> bool:
+        """释放槽位；session_id 保留在头里作为墓碑，保证探测链不断。"""
+        with self._global_lock():
+            slot = self.find(session_id)
+            if slot is None:
+                return False
+            with self.lock(slot):
+                self._header_view(slot)[1][0] = SLOT_FREE
+            return True
+
+    def arrays(self, slot: int) -> Dict[str, np.ndarray]:
+        """槽位内各数组的零拷贝视图（只读 arena 上是只读视图）。"""
+        base = self._slot_offset(slot)
+        return {
+            name: np.ndarray(shape, dtype=dt, buffer=self._mm, offset=base + off)
+            for name, (off, shape, dt) in self._layout.items()
+        }
+
+    def session_ids(self) -> List[str]:
+        ids = []
+        for slot in range(self.n_slots):
+            id_view, state = self._header_view(slot)
+            if state[0] == SLOT_USED:
+                ids.append(bytes(id_view).rstrip(b"\0").decode("utf-8"))
+        return ids
+
+    # ----------------------------- 对齐器 ---------------------------------
+    def attach(self, aligner: LatentAligner, session_id: str) -> Tuple[int, bool]:
+        """
+        把对齐器的持久状态绑定到 session_id 的槽位：
+        - 槽位已存在：直接采用里面的状态（别的 worker / 崩溃前写下的）
+        - 新分配：把对齐器当前状态拷进去
+        返回 (槽位号, 是否新分配)
+        """
+        if aligner.D != self.D or aligner.k_max != self.k_max or aligner.dtype != self.dtype:
+            raise ValueError("对齐器的 D / k_max / dtype 与 arena 不一致")
+        slot, created = self.acquire(session_id)
+        with self.lock(slot):
+            views = self.arrays(slot)
+            meta = views["_meta"]
+            aligner.bind({**views, "_meta": meta[:2]}, adopt=not created)
+            if created:
+                meta[2] = 0
+        return slot, created
+
+    def snapshot(self, session_id: str) -> Optional[Dict[str, np.ndarray]]:
+        """分析用：读出某个会话当前的 k、B、θ 等（持锁拷贝一份，保证一致）。"""
+        slot = self.find(session_id)
+        if slot is None:
+            return None
+        with self.lock(slot):
+            views = self.arrays(slot)
+            k = int(views["_meta"][0])
+            return {
+                "k": k,
+                "version": int(views["_meta"][1]),
+                "B": views["_B_buf"][:, :k].copy(),
+                "A": views["_A_buf"][:k, :k].copy(),
+                "theta": views["_theta_buf"][:k].copy(),
+            }
+
+    def prefs(self, min_version: int = 0) -> Iterator[Tuple[str, np.ndarray]]:
+        """
+        逐个给出 (session_id, w_hat = B θ)，用于从已存状态构建群体模型：
+        - 只在锁内算一次 D x k 乘法，不拷贝 B
+        - version 小于 min_version 的会话（还没学到东西）跳过
+        """
+        for session_id in self.session_ids():
+            slot = self.find(session_id)
+            if slot is None:
+                continue
+            with self.lock(slot):
+                views = self.arrays(slot)
+                k, version = int(views["_meta"][0]), int(views["_meta"][1])
+                if version < min_version:
+                    continue
+                w = views["_B_buf"][:, :k] @ views["_theta_buf"][:k]
+            yield session_id, w
+
+    def flush(self) -> None:
+        if not self.readonly:
+            self._mm.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._mm.close()
+        os.close(self._fd)
@@ -10,7 +10,32 @@ ERR_THRESH = 0.12  # 均方误差大于这个阈值 → 尝试升维
 T_STEPS = 400      # 模拟交互轮数
 SEED = 42          # 随机种子方便复现
 EXPLORE_PROB = 0.3 # 采样行为时用于随机探索的概率
+ACTION_STRATEGY = "thompson" # 行为选择策略："random" / "thompson" / "ucb"
+POSTERIOR_SCALE = 0.3        # Thompson 采样的后验尺度
+UCB_BETA = 1.0               # UCB 的置信宽度
+TARGET_COS = 0.8             # 模拟里统计“多少轮达到该 cos 相似度”
 RESIDUAL_NORM_THRESH = 0.03  # 升维时允许的最小正交残差
 BAD_MEAN_THRESH = -0.2       # 最近 reward 均值低于该值才认为整体体验差
 MIN_BAD_SPAN = 10            # 计算平均 reward 的最小窗口
 EXPAND_COOLDOWN = 10         # 升维冷却步数
+ALIGNER_DTYPE = "float64"    # 对齐器存储精度，"float32" 可让每个会话的内存减半
+COMPACT_K = 6                # 子空间到 MAX_K 后压缩保留的维度，腾出位置继续升维（None 表示不压缩）
+WARM_START_K = 4             # 用群体模型热启动新会话时的初始子空间维度
+POP_BASIS = 8                # 群体模型共享主方向的个数
+POP_CLUSTERS = 256           # 群体模型倒排索引的簇数
+POP_SYNC_SECONDS = 60        # 有 arena 时每隔多少秒从共享状态重建一次群体模型
+LOG_BATCH = 32               # 日志攒够多少条再批量写入 SQLite
+LOG_FLUSH_SECONDS = 1.0      # 或者距上次落盘超过这么多秒
+LOG_RETENTION_DAYS = 30      # 日志保留天数
+LOG_MAX_MB = 512             # 日志库大小上限，超出后从最老的删起
+ARENA_PATH = None            # 对齐器共享内存 arena 文件路径（多 worker 部署时设置，None 表示每个进程各自持有）
+ARENA_SLOTS = 4096           # arena 的会话槽位数
+PUBSUB_BACKEND = "local"     # 状态事件的分发方式："local"（单进程）/ "socket"（同机多 worker）/ "redis"（跨机器）
+PUBSUB_URL = None            # socket 后端的目录或 redis://host:port/db，None 用默认值
+PUBSUB_COALESCE_MS = 100     # 同一会话在这个间隔内的多次状态变化只推送最新一次
+PROFILE_INTERVAL_MS = 5      # 采样 profiler 的默认采样间隔
+PROFILE_MAX_DEPTH = 64       # 每个样本最多保留的调用栈深度
+STYLE_CODE_DIMS = 32         # 写进 prompt 的 style_code 维数，D 更大时用固定随机投影压缩
+SYNTH_LATENCY = "lognormal:800,0.5"  # 合成 / 回放兜底后端的延迟分布（毫秒），见 llm_backends.parse_latency
+SYNTH_REPLY_CHARS = (40, 240)        # 合成回复的字数范围
+SYNTH_TOKENS_PER_CHAR = 0.7          # 合成后端估算 usage 时每个字符折合的 token 数
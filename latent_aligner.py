@@ -1,7 +1,7 @@
 # latent_aligner.py
 import numpy as np
 from dataclasses import dataclass, field
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 
 @dataclass
@@ -21,46 +21,181 @@ class LatentAligner:
 
     rng: np.random.Generator = field(default_factory=np.random.default_rng)
     explore_prob: float = 0.3  # 探索概率，越大越偏随机
+    strategy: str = "random"   # 行为选择策略："random" / "thompson" / "ucb"
+    posterior_scale: float = 0.3  # Thompson 采样的后验尺度 σ
+    ucb_beta: float = 1.0         # UCB 的置信宽度 β
+    dtype: np.dtype = np.float64  # 存储精度，float32 可把每个会话的内存减半
 
-    B: np.ndarray = field(init=False)   # D x k, 列正交的基
-    k: int = field(init=False)         # 当前维度
-    A: np.ndarray = field(init=False)  # k x k, 特征协方差矩阵
-    b: np.ndarray = field(init=False)  # k, 响应向量
-    theta: np.ndarray = field(init=False)  # k, 回归系数
     grad_residual: np.ndarray = field(init=False)  # D, 残差方向累积
 
+    # 标量状态也放在数组里：[k, version]，这样整份状态都可以换成共享内存（见 bind）
+    _meta: np.ndarray = field(init=False, repr=False)
+
+    # 按 k_max 一次性预分配的存储，B/A/b/theta 都是其前 k 维的视图
+    _B_buf: np.ndarray = field(init=False, repr=False)      # D x k_max
+    _A_buf: np.ndarray = field(init=False, repr=False)      # k_max x k_max
+    _b_buf: np.ndarray = field(init=False, repr=False)      # k_max
+    _theta_buf: np.ndarray = field(init=False, repr=False)  # k_max
+    # 热路径上的临时缓冲，避免每轮重新分配
+    _a_buf: np.ndarray = field(init=False, repr=False)      # D
+    _x_buf: np.ndarray = field(init=False, repr=False)      # k_max
+    _xx_buf: np.ndarray = field(init=False, repr=False)     # k_max x k_max
+    # w_hat = B θ 的缓存，version 变了才重算
+    _w_hat: np.ndarray = field(init=False, repr=False)
+    _w_hat_version: int = field(init=False, repr=False, default=-1)
+
     def __post_init__(self):
+        self.dtype = np.dtype(self.dtype)
+        D, k_max = self.D, self.k_max
+        self._meta = np.zeros(2, dtype=np.int64)
+        self._B_buf = np.zeros((D, k_max), dtype=self.dtype)
+        self._A_buf = np.zeros((k_max, k_max), dtype=self.dtype)
+        self._b_buf = np.zeros(k_max, dtype=self.dtype)
+        self._theta_buf = np.zeros(k_max, dtype=self.dtype)
+        self._a_buf = np.zeros(D, dtype=self.dtype)
+        self._x_buf = np.zeros(k_max, dtype=self.dtype)
+        self._xx_buf = np.zeros((k_max, k_max), dtype=self.dtype)
+
         # 初始化子空间基底
         B0 = self.rng.normal(0, 1, size=(self.D, self.k_init))
         B0, _ = np.linalg.qr(B0)  # QR 分解得到列正交基
-        self.B = B0
         self.k = self.k_init
+        self.B[:] = B0
+
+        self.A[:] = self.lam * np.eye(self.k)
+        self.grad_residual = np.zeros(self.D, dtype=self.dtype)
+
+    # ----------------------------- 状态视图 ---------------------------------
+    @property
+    def k(self) -> int:
+        """当前维度"""
+        return int(self._meta[0])
+
+    @k.setter
+    def k(self, value: int) -> None:
+        self._meta[0] = value
+
+    @property
+    def version(self) -> int:
+        """状态版本，每次更新/升维/压缩后 +1"""
+        return int(self._meta[1])
+
+    @version.setter
+    def version(self, value: int) -> None:
+        self._meta[1] = value
+
+    @property
+    def B(self) -> np.ndarray:
+        """D x k, 列正交的基"""
+        return self._B_buf[:, : self.k]
+
+    @property
+    def A(self) -> np.ndarray:
+        """k x k, 特征协方差矩阵"""
+        return self._A_buf[: self.k, : self.k]
+
+    @property
+    def b(self) -> np.ndarray:
+        """k, 响应向量"""
+        return self._b_buf[: self.k]
+
+    @property
+    def theta(self) -> np.ndarray:
+        """k, 回归系数"""
+        return self._theta_buf[: self.k]
+
+    @property
+    def nbytes(self) -> int:
+        """对齐器所有数组状态（含预分配缓冲）占用的字节数"""
+        return sum(v.nbytes for v in vars(self).values() if isinstance(v, np.ndarray))
+
+    STATE_BUFFERS = ("_meta", "_B_buf", "_A_buf", "_b_buf", "_theta_buf", "grad_residual")
+
+    def bind(self, buffers: Dict[str, np.ndarray], adopt: bool) -> None:
+        """
+        把持久状态（STATE_BUFFERS）换成外部提供的存储，例如共享内存 arena 的槽位视图：
+        - adopt=True：直接采用外部存储里已有的状态
+        - adopt=False：先把当前状态拷进去
+        临时缓冲仍留在本进程
+        """
+        for name in self.STATE_BUFFERS:
+            ours, theirs = getattr(self, name), buffers[name]
+            if theirs.shape != ours.shape or theirs.dtype != ours.dtype:
+                raise ValueError(
+                    f"{name} 的外部存储是 {theirs.shape}/{theirs.dtype}，需要 {ours.shape}/{ours.dtype}"
+                )
+            if not adopt:
+                theirs[...] = ours
+        for name in self.STATE_BUFFERS:
+            setattr(self, name, buffers[name])
+        self._w_hat_version = -1
+
+    def sample_action(self, alpha: float = 0.3, strategy: Optional[str] = None) -> np.ndarray:
+        """
+        采样下一轮的行为向量：
+        - 子空间内的方向按策略选：
+            random   —— 均匀随机方向，不看 θ / A（老逻辑）
+            thompson —— 从 ridge 后验 N(θ, σ² A^{-1}) 采一个 w̃，取 w̃ 的方向
+            ucb      —— 在一批候选方向里取 θ^T z + β·sqrt(z^T A^{-1} z) 最大的
+        - 非 random 策略下，以 explore_prob 的概率退回随机方向
+        - 最后再加一点“子空间外”的探索噪声，供残差挖新维度
+        """
+        strategy = strategy or self.strategy
+        if strategy != "random" and self.rng.random() < self.explore_prob:
+            strategy = "random"
+
+        # 1. 先在当前子空间里选一个方向
+        if strategy == "thompson":
+            z = self._thompson_direction()
+        elif strategy == "ucb":
+            z = self._ucb_direction()
+        elif strategy == "random":
+            z = self.rng.standard_normal(self.k, dtype=self.dtype)
+        else:
+            raise ValueError(f"未知的行为选择策略: {strategy}")
+        z /= np.linalg.norm(z) + 1e-9
 
-        self.A = self.lam * np.eye(self.k)
-        self.b = np.zeros(self.k)
-        self.theta = np.zeros(self.k)
-        self.grad_residual = np.zeros(self.D)
+        # 2. 再加一点“子空间外”的探索噪声 u_orth = u - B(B^T u)
+        # B 列正交，所以 |u_orth|² = |u|² - |B^T u|²，并且
+        #   B z + α u_orth/|u_orth| = B (z - s·B^T u) + s·u,  s = α/|u_orth|
+        # 只做两次 D x k 乘法，也不需要 D 维的中间向量
+        u = self.rng.standard_normal(self.D, dtype=self.dtype)
+        c = self.B.T @ u
+        uu = float(u @ u)
+        orth_sq = uu - float(c @ c)
+        # 相对阈值：k 接近 D 时正交分量可能只剩舍入误差
+        if orth_sq > 1e-4 * uu:
+            s = alpha / orth_sq ** 0.5
+            z -= s * c
+            u *= s
+            a = np.dot(self.B, z, out=np.empty(self.D, dtype=self.dtype))
+            a += u
+        else:
+            a = self.B @ z
 
-    def sample_action(self, alpha: float = 0.3) -> np.ndarray:
-    # 1. 先在当前子空间里采一个方向（老逻辑）
-     z = self.rng.normal(0, 1, size=self.k)
-     z /= np.linalg.norm(z) + 1e-9
-     a_in = self.B @ z
+        a /= np.linalg.norm(a) + 1e-9
+        return a
 
-    # 2. 再加一点“子空间外”的探索噪声
-     u = self.rng.normal(0, 1, size=self.D)
-    # 去掉在当前子空间里的部分，留下正交分量
-     u_orth = u - self.B @ (self.B.T @ u)
-     nrm = np.linalg.norm(u_orth)
-     if nrm > 1e-6:
-        u_orth /= nrm
-        a = a_in + alpha * u_orth
-     else:
-        a = a_in
+    def _thompson_direction(self) -> np.ndarray:
+        """从后验 N(θ, σ² A^{-1}) 采样：A = L L^T，则 L^{-T} ε 的协方差为 A^{-1}"""
+        L = np.linalg.cholesky(self.A)
+        eps = self.rng.standard_normal(self.k, dtype=self.dtype)
+        return self.theta + self.posterior_scale * np.linalg.solve(L.T, eps)
 
-     a /= np.linalg.norm(a) + 1e-9
-     return a
+    def _ucb_direction(self, n_candidates: int = 64) -> np.ndarray:
+        """在随机候选方向（外加 θ 方向本身）里取置信上界最大的那个"""
+        Z = self.rng.standard_normal((n_candidates, self.k), dtype=self.dtype)
+        Z /= np.linalg.norm(Z, axis=1, keepdims=True) + 1e-9
+        theta = self.theta
+        theta_norm = np.linalg.norm(theta)
+        if theta_norm > 0:
+            Z[0] = theta / theta_norm
 
+        A_inv = np.linalg.inv(self.A)
+        # z_i^T A^{-1} z_i：先一次矩阵乘，再逐行点积（三操作数 einsum 在 k 大时很慢）
+        width = np.sqrt(np.einsum("ij,ij->i", Z @ A_inv, Z))
+        scores = Z @ theta + self.ucb_beta * width
+        return Z[int(np.argmax(scores))].copy()
 
     def predict(self, action: np.ndarray) -> float:
         """在当前子空间内预测用户反馈"""
@@ -73,25 +208,68 @@ class LatentAligner:
         - 子空间内 ridge 回归参数
         - 残差累积向量 grad_residual
         """
-        action = action.astype(float)
-        action /= np.linalg.norm(action) + 1e-9
+        # 拷进预分配缓冲，不改动调用方的 action
+        a = self._a_buf
+        np.copyto(a, action, casting="unsafe")
+        a /= np.sqrt(a @ a) + 1e-9
 
-        x = self.B.T @ action
-        r_hat = float(self.theta @ x)
+        k = self.k
+        A, b, theta = self.A, self.b, self.theta
+        x = np.dot(self.B.T, a, out=self._x_buf[:k])
+        r_hat = float(theta @ x)
 
         # 对齐信号直接取 reward（或优势），不再依赖预测误差
         e = reward
 
-        # 在线更新 ridge 回归: A += x x^T, b += x r
-        self.A += np.outer(x, x)
-        self.b += x * reward
-        self.theta = np.linalg.solve(self.A, self.b)
+        # 在线更新 ridge 回归: A += x x^T, b += x r（全部原地）
+        A += np.multiply(x[:, None], x, out=self._xx_buf[:k, :k])
+        x *= reward
+        b += x
+        theta[:] = np.linalg.solve(A, b)
 
         # 残差方向累积: sum signal_t * a_t
-        self.grad_residual += e * action
+        a *= e
+        self.grad_residual += a
+        self.version += 1
 
         return e, r_hat
 
+    def update_with_batch(self, actions: np.ndarray, rewards: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        一次性吸收 N 个 (a_i, r_i) 样本（离线反馈、A/B 日志等）：
+        - X = 归一化后的 actions 投影到子空间 (N x k)
+        - A += X^T X, b += X^T r, grad_residual += actions^T r，只做一次 solve
+        结果与逐个调用 update_with_sample 在数值误差内一致；
+        含 NaN / inf 时整批拒绝（一个 NaN 就会让 theta 永久变成 NaN）；
+        reward 的取值范围由调用方负责，这里与 update_with_sample 一样原样使用；
+        返回 (对齐信号, 批更新前的预测)
+        """
+        acts = np.asarray(actions, dtype=self.dtype)
+        r = np.asarray(rewards, dtype=self.dtype).ravel()
+        if acts.ndim != 2 or acts.shape[1] != self.D:
+            raise ValueError(f"actions 需要是 N x {self.D} 的矩阵，收到 {acts.shape}")
+        if acts.shape[0] != r.shape[0]:
+            raise ValueError(f"actions 有 {acts.shape[0]} 行，rewards 有 {r.shape[0]} 个")
+        if not np.isfinite(acts).all():
+            raise ValueError("actions 含 NaN 或 inf")
+        if not np.isfinite(r).all():
+            raise ValueError("rewards 含 NaN 或 inf")
+
+        acts = acts / (np.linalg.norm(acts, axis=1, keepdims=True) + 1e-9)
+        A, b, theta = self.A, self.b, self.theta
+        X = acts @ self.B
+        r_hat = X @ theta
+
+        A += X.T @ X
+        b += X.T @ r
+        theta[:] = np.linalg.solve(A, b)
+
+        # 对齐信号同 update_with_sample，直接取 reward
+        self.grad_residual += acts.T @ r
+        self.version += 1
+
+        return r, r_hat
+
     def maybe_expand(self, recent_errors: List[float]) -> bool:
         """
         根据近期误差决定是否升维：
@@ -108,53 +286,127 @@ class LatentAligner:
         return False  # 默认这里不直接触发，由外层控制
         # （在 run_simulation 里根据 mean_err 和阈值再调用 expand_subspace）
 
-    def expand_subspace(self, min_norm: float = 1e-6) -> bool:
+    def expand_subspace(self, min_norm: float = 1e-6, compact_to: Optional[int] = None) -> bool:
         """
         真正的升维操作：
         - 用 grad_residual 作为“新信息”的来源
         - 从当前子空间里投影出去，取正交部分
         - 如果正交部分长度够大，则加入为新基向量
+        - 已到 k_max 时，若给了 compact_to，先压缩到 compact_to 维腾出位置
         """
-        g = self.grad_residual.copy()
-        if np.allclose(g, 0):
+        if np.allclose(self.grad_residual, 0):
             return False
+        if self.k >= self.k_max:
+            if compact_to is None:
+                return False
+            # 先确认残差确实有子空间外的新信息，再压缩，避免白白丢维度
+            g = self.grad_residual
+            if np.linalg.norm(g - self.B @ (self.B.T @ g)) < min_norm:
+                return False
+            if not self.compact_subspace(compact_to):
+                return False
 
-        # 投影到当前子空间: proj = B(B^T g)
-        proj = self.B @ (self.B.T @ g)
-        g_orth = g - proj
+        # 直接在预分配的第 k 列里构造候选方向: g - B(B^T g)
+        k = self.k
+        g_orth = self._B_buf[:, k]
+        np.copyto(g_orth, self.grad_residual)
+        g_orth -= self.B @ (self.B.T @ g_orth)
+        # 再投影一次（两次 Gram-Schmidt），float32 下也能保持列正交
+        g_orth -= self.B @ (self.B.T @ g_orth)
         nrm = float(np.linalg.norm(g_orth))
         if nrm < min_norm:
+            g_orth.fill(0.0)
             return False
 
         g_orth /= nrm
-        # 扩展 B
-        self.B = np.column_stack([self.B, g_orth])
+
+        # 扩维时保留已有的协方差与参数，避免“升维=重置”：
+        # 旧的前 k 维原地不动，只初始化新增的一行一列
+        self._A_buf[k, : k + 1] = 0.0
+        self._A_buf[:k, k] = 0.0
+        self._A_buf[k, k] = self.lam
+        self._b_buf[k] = 0.0
+        self._theta_buf[k] = 0.0
         self.k += 1
+        self.grad_residual.fill(0.0)
+        self.version += 1
 
-        # 扩维时保留已有的协方差与参数，避免“升维=重置”
-        A_old = self.A.copy()
-        theta_old = self.theta.copy()
-        b_old = self.b.copy()
+        return True
 
-        A_new = np.zeros((self.k, self.k))
-        A_new[:-1, :-1] = A_old
-        A_new[-1, -1] = self.lam
-        self.A = A_new
+    def compact_subspace(self, keep: int) -> bool:
+        """
+        子空间压缩：把基旋转到 ridge 后验下的主方向，只保留前 keep 个。
+        - 后验二阶矩 M = θθ^T + A^{-1}：θ 方向承载全部预测，
+          A^{-1} 大的方向还没学明白，两者都值得留下
+        - 特征值小的方向 = 已经确信系数≈0 的方向，丢掉也不影响预测
+        - 旋转后 A、b 直接投影到新基，θ 重新求解；
+          这与只用保留方向做 ridge 回归得到的结果完全一致
+        """
+        k = self.k
+        if keep < 1 or keep >= k:
+            return False
+
+        A, b, theta = self.A, self.b, self.theta
+        M = np.outer(theta, theta) + np.linalg.inv(A)
+        _, R = np.linalg.eigh(M)
+        R = R[:, ::-1][:, :keep]  # 按特征值从大到小取前 keep 个
 
-        theta_new = np.zeros(self.k)
-        theta_new[:-1] = theta_old
-        self.theta = theta_new
+        B_new = self.B @ R
+        A_new = R.T @ A @ R
+        b_new = R.T @ b
 
-        b_new = np.zeros(self.k)
-        b_new[:-1] = b_old
-        self.b = b_new
-        self.grad_residual = np.zeros(self.D)
+        self.k = keep
+        self.B[:] = B_new
+        self.A[:] = A_new
+        self.b[:] = b_new
+        self.theta[:] = np.linalg.solve(self.A, self.b)
+        # 清掉腾出来的槽位，留给后续升维
+        self._B_buf[:, keep:k] = 0.0
+        self._theta_buf[keep:k] = 0.0
+        self._b_buf[keep:k] = 0.0
+        self.version += 1
 
         return True
 
+    def warm_start(self, B0: np.ndarray, theta0: np.ndarray) -> None:
+        """
+        用外部先验（例如群体模型）重置子空间：
+        - B0: D x k 列正交基，theta0: k 维先验系数
+        - 先验以 ridge 的形式进入：A = λI，b = λθ0，
+          相当于把 ridge 的收缩中心从 0 挪到 θ0，之后的样本照常累加
+        """
+        k = B0.shape[1]
+        if k > self.k_max:
+            raise ValueError(f"热启动的维度 {k} 超过了 k_max={self.k_max}")
+
+        for buf in (self._B_buf, self._A_buf, self._b_buf, self._theta_buf):
+            buf.fill(0.0)
+        self.k = k
+        self.B[:] = B0
+        self.A[:] = self.lam * np.eye(k)
+        self.b[:] = self.lam * np.asarray(theta0)
+        self.theta[:] = theta0
+        self.grad_residual.fill(0.0)
+        self.version += 1
+
+    def shift_prior(self, delta: np.ndarray) -> None:
+        """
+        把 ridge 的收缩中心在当前子空间内平移 B^T delta（delta 是 D 维偏好的变化量）：
+        b += λ B^T delta，再重解 θ；已经累加的样本保留
+        """
+        b = self.b
+        b += self.lam * (self.B.T @ np.asarray(delta))
+        self.theta[:] = np.linalg.solve(self.A, b)
+        self.version += 1
+
     def current_approx_pref(self) -> np.ndarray:
         """
         当前系统在 D 维空间里对用户偏好的近似：
         w_hat = B θ
+        按 version 缓存，只在更新/升维/压缩后重算；返回的是只读数组
         """
-        return self.B @ self.theta
+        if self._w_hat_version != self.version:
+            self._w_hat = self.B @ self.theta
+            self._w_hat.flags.writeable = False
+            self._w_hat_version = self.version
+        return self._w_hat
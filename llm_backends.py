@@ -0,0 +1,329 @@
+"""Pluggable chat-completion backends for LLMBridge: live API, recording, replay and synthetic."""
+from __future__ import annotations
+
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Deque, Dict, List, Optional, Union
+
+import numpy as np
+
+from config import (
+    SYNTH_LATENCY,
+    SYNTH_REPLY_CHARS,
+    SYNTH_TOKENS_PER_CHAR,
+)
+
+Messages = List[Dict[str, str]]
+LatencyModel = Callable[[np.random.Generator], float]
+
+
+@dataclass
+class Completion:
+    content: str
+    usage: Dict[str, int] = field(default_factory=dict)
+    latency: float = 0.0  # 秒，生成这条回复花的时间（回放 / 合成时是模拟出来的）
+
+
+def _usage(prompt_tokens: int, completion_tokens: int) -> Dict[str, int]:
+    return {
+        "prompt_tokens": int(prompt_tokens),
+        "completion_tokens": int(completion_tokens),
+        "total_tokens": int(prompt_tokens + completion_tokens),
+    }
+
+
+def request_key(kind: str, model: str, messages: Messages, temperature: float) -> str:
+    """完整请求的指纹，录制和回放用它精确匹配。"""
+    raw = json.dumps([kind, model, messages, temperature], ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def loose_key(kind: str, messages: Messages) -> str:
+    """只看请求类型和最后一条消息：action 是随机采样的，回复请求的 system prompt 很难逐字重现。"""
+    last = messages[-1]["content"] if messages else ""
+    return hashlib.blake2b(f"{kind}\0{last}".encode("utf-8"), digest_size=12).hexdigest()
+
+
+def parse_latency(spec: str) -> LatencyModel:
+    """
+    延迟分布（毫秒）：
+    - "fixed:300"
+    - "uniform:200,900"
+    - "lognormal:800,0.5"   中位数 800ms，对数标准差 0.5
+    - "empirical:<录制文件>" 从录制下来的真实延迟里重采样
+    """
+    name, _, args = spec.partition(":")
+    if name == "empirical":
+        latencies = [rec["latency"] for rec in read_records(args)]
+        if not latencies:
+            raise ValueError(f"{args} 里没有可用的延迟样本")
+        samples = np.asarray(latencies)
+        return lambda rng: float(samples[rng.integers(len(samples))])
+    try:
+        values = [float(v) for v in args.split(",")]
+    except ValueError:
+        values = []
+    if name == "fixed" and len(values) == 1:
+        seconds = values[0] / 1000
+        return lambda rng: seconds
+    if name == "uniform" and len(values) == 2:
+        low, high = values[0] / 1000, values[1] / 1000
+        return lambda rng: float(rng.uniform(low, high))
+    if name == "lognormal" and len(values) == 2:
+        median, sigma = values[0] / 1000, values[1]
+        return lambda rng: float(median * np.exp(sigma * rng.standard_normal()))
+    raise ValueError(f"无法解析的延迟分布: {spec!r}")
+
+
+class ChatBackend(ABC):
+    """LLMBridge 下面的一层：给定一次 chat 请求，返回 Completion。kind 是 "reply" 或 "reward"。"""
+
+    @abstractmethod
+    def complete(self, kind: str, model: str, messages: Messages, temperature: float) -> Completion:
+        """完成一次 chat 请求。"""
+
+    def close(self) -> None:
+        pass
+
+
+class OpenAIBackend(ChatBackend):
+    """真实的 OpenAI 兼容接口（默认 DeepSeek）。"""
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None) -> None:
+        from openai import OpenAI
+
+        api_key = api_key or os.getenv("DEEPSEEK_API_KEY") or os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("请先在环境变量中设置 DEEPSEEK_API_KEY（或 OPENAI_API_KEY）。")
+        base_url = base_url or os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com")
+        self.client = OpenAI(api_key=api_key, base_url=base_url.rstrip("/"))
+
+    def complete(self, kind: str, model: str, messages: Messages, temperature: float) -> Completion:
+        start = time.perf_counter()
+        resp = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+        )
+        latency = time.perf_counter() - start
+        usage = resp.usage or None
+        return Completion(
+            content=resp.choices[0].message.content.strip(),
+            usage=_usage(getattr(usage, "prompt_tokens", 0), getattr(usage, "completion_tokens", 0)),
+            latency=latency,
+        )
+
+
+def per_process_path(path: Union[str, Path], tag: Union[int, str, None] = None) -> Path:
+    """
+    在文件名第一个扩展名前插入进程号：logs/llm_records.jsonl.gz → logs/llm_records.<pid>.jsonl.gz。
+    多个 worker 各写各的录制文件，几个 gzip 流追加到同一个文件会互相穿插、把文件写坏
+    """
+    path = Path(path)
+    stem, dot, rest = path.name.partition(".")
+    tag = os.getpid() if tag is None else tag
+    return path.with_name(f"{stem}.{tag}{dot}{rest}")
+
+
+def record_files(path: Union[str, Path]) -> List[Path]:
+    """path 存在就只读它，否则读按进程拆开的那一组文件（per_process_path(path, "*")），也可以直接给通配符。"""
+    path = Path(path)
+    if path.exists():
+        return [path]
+    pattern = path if any(ch in path.name for ch in "*?[") else per_process_path(path, "*")
+    return sorted(pattern.parent.glob(pattern.name))
+
+
+def read_records(path: Union[str, Path]) -> List[Dict]:
+    """读录制文件（gzip 压缩的 JSON lines；进程被杀时最后一段可能不完整，读到哪算哪）。"""
+    records = []
+    for file in record_files(path):
+        try:
+            with gzip.open(file, "rt", encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        except (EOFError, gzip.BadGzipFile):
+            pass
+    return records
+
+
+class RecordingBackend(ChatBackend):
+    """
+    包住另一个后端，把每次请求的指纹、回复、usage 和延迟追加到录制文件：
+    - 一行一个 JSON，gzip 压缩；不存整段 prompt（历史会重复很多次），只存两个指纹
+    - 每条写完都 sync flush，进程崩溃时已写入的记录仍然能读出来
+    """
+
+    def __init__(self, inner: ChatBackend, path: Union[str, Path]) -> None:
+        self.inner = inner
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._fh = gzip.open(self.path, "at", encoding="utf-8")
+        atexit.register(self.close)
+
+    def complete(self, kind: str, model: str, messages: Messages, temperature: float) -> Completion:
+        result = self.inner.complete(kind, model, messages, temperature)
+        record = {
+            "ts": round(time.time(), 3),
+            "kind": kind,
+            "model": model,
+            "key": request_key(kind, model, messages, temperature),
+            "loose": loose_key(kind, messages),
+            "latency": round(result.latency, 4),
+            "usage": [result.usage.get("prompt_tokens", 0), result.usage.get("completion_tokens", 0)],
+            "content": result.content,
+        }
+        with self._lock:
+            if self._fh is not None:
+                self._fh.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+                self._fh.flush()
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+        self.inner.close()
+
+
+class SyntheticBackend(ChatBackend):
+    """
+    不联网的合成后端，压测和离线基准用：
+    - reply：按 SYNTH_REPLY_CHARS 长度生成占位文本
+    - reward：输出合法的 reward JSON，数值在 [-1, 1] 上均匀分布
+    - usage 按字符数 × SYNTH_TOKENS_PER_CHAR 估算
+    - 延迟按给定分布采样，再除以 speed（speed=10 表示快 10 倍）；sleep=False 时只记录不等待
+    """
+
+    def __init__(
+        self,
+        latency: Union[str, LatencyModel] = SYNTH_LATENCY,
+        speed: float = 1.0,
+        seed: int = 0,
+        sleep: bool = True,
+    ) -> None:
+        self.latency = parse_latency(latency) if isinstance(latency, str) else latency
+        self.speed = speed
+        self.sleep = sleep
+        self.rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def _tokens(self, text: str) -> int:
+        return max(1, int(round(len(text) * SYNTH_TOKENS_PER_CHAR)))
+
+    def _wait(self, latency: float) -> None:
+        if self.sleep and latency > 0:
+            time.sleep(latency / self.speed)
+
+    def complete(self, kind: str, model: str, messages: Messages, temperature: float) -> Completion:
+        with self._lock:
+            latency = max(0.0, self.latency(self.rng))
+            if kind == "reward":
+                content = json.dumps({"reward": round(float(self.rng.uniform(-1, 1)), 3), "hard_flags": []})
+            else:
+                n_chars = int(self.rng.integers(SYNTH_REPLY_CHARS[0], SYNTH_REPLY_CHARS[1] + 1))
+                content = "（合成回复）" + "好" * max(0, n_chars - 6)
+        prompt_tokens = sum(self._tokens(m["content"]) for m in messages)
+        self._wait(latency)
+        return Completion(content=content, usage=_usage(prompt_tokens, self._tokens(content)), latency=latency)
+
+
+class ReplayBackend(ChatBackend):
+    """
+    按录制文件回放：
+    - 先按完整指纹匹配，再按“类型 + 最后一条消息”匹配，同一个键录到多次就按顺序轮流给
+    - 都没匹配上时交给 fallback（默认合成后端）；fallback=None 则抛 KeyError
+    - 等待录制时的真实延迟 / speed，整天的流量可以加速回放
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        speed: float = 1.0,
+        fallback: Optional[ChatBackend] = None,
+        sleep: bool = True,
+    ) -> None:
+        self.path = Path(path)
+        self.speed = speed
+        self.sleep = sleep
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._exact: Dict[str, Deque[Dict]] = defaultdict(deque)
+        self._loose: Dict[str, Deque[Dict]] = defaultdict(deque)
+        for record in read_records(self.path):
+            self._exact[record["key"]].append(record)
+            self._loose[record["loose"]].append(record)
+        self.hits = {"exact": 0, "loose": 0, "miss": 0}
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self._exact.values())
+
+    def _take(self, table: Dict[str, Deque[Dict]], key: str) -> Optional[Dict]:
+        queue = table.get(key)
+        if not queue:
+            return None
+        record = queue[0]
+        queue.rotate(-1)
+        return record
+
+    def complete(self, kind: str, model: str, messages: Messages, temperature: float) -> Completion:
+        with self._lock:
+            record = self._take(self._exact, request_key(kind, model, messages, temperature))
+            if record is not None:
+                self.hits["exact"] += 1
+            else:
+                record = self._take(self._loose, loose_key(kind, messages))
+                self.hits["loose" if record is not None else "miss"] += 1
+        if record is None:
+            if self.fallback is None:
+                raise KeyError(f"录制文件 {self.path} 里没有匹配的 {kind} 请求")
+            return self.fallback.complete(kind, model, messages, temperature)
+        if self.sleep and record["latency"] > 0:
+            time.sleep(record["latency"] / self.speed)
+        return Completion(
+            content=record["content"],
+            usage=_usage(*record["usage"]),
+            latency=record["latency"],
+        )
+
+
+def make_backend(
+    name: str,
+    record_path: Optional[Union[str, Path]] = None,
+    speed: float = 1.0,
+    latency: str = SYNTH_LATENCY,
+) -> ChatBackend:
+    """
+    按名字创建后端：
+    - "openai"：真实接口
+    - "record"：真实接口 + 录制到 record_path（文件名里带进程号，见 per_process_path）
+    - "replay"：回放 record_path（或它按进程拆开的那一组文件），没匹配上的用合成后端兜底
+    - "synthetic"：纯合成
+    """
+    if name == "openai":
+        return OpenAIBackend()
+    if name == "record":
+        if record_path is None:
+            raise ValueError("record 后端需要 record_path")
+        return RecordingBackend(OpenAIBackend(), per_process_path(record_path))
+    if name == "replay":
+        if record_path is None:
+            raise ValueError("replay 后端需要 record_path")
+        return ReplayBackend(record_path, speed=speed, fallback=SyntheticBackend(latency, speed=speed))
+    if name == "synthetic":
+        return SyntheticBackend(latency, speed=speed)
+    raise ValueError(f"unknown LLM backend: {name}")
@@ -1,11 +1,16 @@
 # llm_bridge.py
 import os
 import json
-from typing import List, Tuple, Dict
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 from dotenv import load_dotenv
-from openai import OpenAI
+
+from config import STYLE_CODE_DIMS
+from llm_backends import ChatBackend, make_backend
 
 # 允许从 .env 中加载 API key / 模型配置
 load_dotenv()
@@ -13,7 +18,44 @@ load_dotenv()
 # 可以根据你账号的权限改成别的模型名，也可以通过环境变量覆盖
 LLM_MODEL_ACTOR = os.getenv("LLM_MODEL_ACTOR", "deepseek-chat")
 LLM_MODEL_REWARD = os.getenv("LLM_MODEL_REWARD", "deepseek-chat")
-DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com")
+# 后端："openai"（默认）/ "record"（调用真实接口并录制）/ "replay"（回放录制文件）/ "synthetic"（纯合成）
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+LLM_RECORD_PATH = os.getenv("LLM_RECORD_PATH") or str(
+    Path(__file__).resolve().parent / "logs" / "llm_records.jsonl.gz"
+)
+LLM_REPLAY_SPEED = float(os.getenv("LLM_REPLAY_SPEED", "1.0"))
+
+_default_backend: Optional[ChatBackend] = None
+_default_lock = threading.Lock()
+
+
+def default_backend() -> ChatBackend:
+    """进程内共享的默认后端（按 LLM_BACKEND 创建），所有会话共用一个客户端 / 一个录制文件句柄。"""
+    global _default_backend
+    with _default_lock:
+        if _default_backend is None:
+            _default_backend = make_backend(LLM_BACKEND, record_path=LLM_RECORD_PATH, speed=LLM_REPLAY_SPEED)
+        return _default_backend
+
+
+@lru_cache(maxsize=8)
+def _style_sketch(dim: int, code_dims: int) -> np.ndarray:
+    """
+    固定种子的高斯随机投影（code_dims x dim）：
+    近似保持向量间的夹角，相似的 action 仍然得到相似的 style_code，
+    并且跨进程、跨重启都是同一个投影
+    """
+    rng = np.random.default_rng(20240601)
+    return rng.standard_normal((code_dims, dim), dtype=np.float32) / np.float32(np.sqrt(code_dims))
+
+
+def compress_action(action_vec: np.ndarray, code_dims: int = STYLE_CODE_DIMS) -> np.ndarray:
+    """把 D 维 action 压成 code_dims 维的单位向量写进 prompt；D 不超过 code_dims 时原样归一化。"""
+    v = np.asarray(action_vec, dtype=np.float32).ravel()
+    if v.size > code_dims:
+        v = _style_sketch(v.size, code_dims) @ v
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm > 0 else np.zeros_like(v)
 
 
 class LLMBridge:
@@ -29,12 +71,11 @@ class LLMBridge:
         让 LLM 读出“上一轮风格在多大程度上让用户满意”，输出 reward ∈ [-1, 1]。
     """
 
-    def __init__(self, model_actor: str = None, model_reward: str = None) -> None:
-        api_key = os.getenv("DEEPSEEK_API_KEY") or os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise RuntimeError("请先在环境变量中设置 DEEPSEEK_API_KEY（或 OPENAI_API_KEY）。")
-
-        self.client = OpenAI(api_key=api_key, base_url=DEEPSEEK_API_BASE.rstrip("/"))
+    def __init__(
+        self, model_actor: str = None, model_reward: str = None, backend: Optional[ChatBackend] = None
+    ) -> None:
+        # 不传 backend 时用进程内共享的默认后端；只有真实接口（openai / record）才需要 API key
+        self.backend = backend or default_backend()
         self.model_actor = model_actor or LLM_MODEL_ACTOR
         self.model_reward = model_reward or LLM_MODEL_REWARD
 
@@ -42,14 +83,8 @@ class LLMBridge:
     # 1) latent action → LLM 回复（风格控制）
     # ---------------------------------------------------------------------
     def _format_action_profile(self, action_vec: np.ndarray) -> str:
-        v = np.asarray(action_vec, dtype=float)
-        if v.ndim != 1:
-            v = v.ravel()
-        norm = float(np.linalg.norm(v))
-        if norm > 0:
-            v = v / norm
-        else:
-            v = np.zeros_like(v)
+        # 高维 action（句向量尺度）先压缩，prompt 长度与 D 无关
+        v = compress_action(action_vec)
 
         style_code = ",".join(f"{val:+.3f}" for val in v)
         profile = (
@@ -88,18 +123,8 @@ class LLMBridge:
         # 当前这轮的用户输入
         messages.append({"role": "user", "content": user_msg})
 
-        resp = self.client.chat.completions.create(
-            model=self.model_actor,
-            messages=messages,
-            temperature=0.7,
-        )
-        usage = resp.usage or None
-        usage_dict = {
-            "prompt_tokens": getattr(usage, "prompt_tokens", 0),
-            "completion_tokens": getattr(usage, "completion_tokens", 0),
-            "total_tokens": getattr(usage, "total_tokens", 0),
-        }
-        return resp.choices[0].message.content.strip(), usage_dict
+        resp = self.backend.complete("reply", self.model_actor, messages, temperature=0.7)
+        return resp.content, resp.usage
 
     # ---------------------------------------------------------------------
     # 2) 用户自然反应 → 对上一轮的 reward
@@ -156,12 +181,8 @@ class LLMBridge:
             },
         ]
 
-        resp = self.client.chat.completions.create(
-            model=self.model_reward,
-            messages=messages,
-            temperature=0.2,
-        )
-        raw = resp.choices[0].message.content.strip()
+        resp = self.backend.complete("reward", self.model_reward, messages, temperature=0.2)
+        raw = resp.content
 
         try:
             parsed = json.loads(raw)
@@ -173,13 +194,7 @@ class LLMBridge:
 
         # 裁剪到 [-1, 1]
         r = max(-1.0, min(1.0, r))
-        usage = resp.usage or None
-        usage_dict = {
-            "prompt_tokens": getattr(usage, "prompt_tokens", 0),
-            "completion_tokens": getattr(usage, "completion_tokens", 0),
-            "total_tokens": getattr(usage, "total_tokens", 0),
-        }
-        return r, usage_dict, [str(flag) for flag in hard_flags]
+        return r, resp.usage, [str(flag) for flag in hard_flags]
 
     # 为兼容老代码，保留旧 API 名称
     def estimate_reward_from_reaction(
@@ -0,0 +1,269 @@
+"""Append-optimized, indexed turn log shared by all sessions and workers."""
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from config import LOG_BATCH, LOG_FLUSH_SECONDS, LOG_MAX_MB, LOG_RETENTION_DAYS
+
+TimeLike = Union[float, datetime, None]
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turn_logs (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    turn INTEGER,
+    reward REAL,
+    k INTEGER,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_turn_logs_session_ts ON turn_logs (session_id, ts);
+CREATE INDEX IF NOT EXISTS idx_turn_logs_ts ON turn_logs (ts);
+"""
+
+
+def _to_epoch(value: TimeLike) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+
+class LogStore:
+    """
+    SQLite（WAL 模式）上的对话日志：
+    - 每行一个事件，按 (session_id, ts) 和 ts 建索引，按会话 / 时间段查询不用扫全量
+    - 写入先进内存缓冲，攒够 batch_size 条或超过 flush_seconds 再一次性事务写入；
+      后台线程每 flush_seconds 检查一次，没有新写入时缓冲也不会一直留在内存里，
+      进程被强杀最多丢最近 flush_seconds 内的日志
+    - 多个 worker 进程可以同时写同一个库（WAL + busy_timeout）
+    - 保留策略按时间和库大小，而不是按文件个数
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        batch_size: int = LOG_BATCH,
+        flush_seconds: float = LOG_FLUSH_SECONDS,
+        retention_days: Optional[float] = LOG_RETENTION_DAYS,
+        max_bytes: Optional[int] = LOG_MAX_MB * 1024 * 1024,
+    ) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._buffer: List[Tuple[str, float, Optional[int], Optional[float], Optional[int], str]] = []
+        self._last_flush = time.monotonic()
+        self._flushes = 0
+
+        self._conn = sqlite3.connect(str(self.path), timeout=5.0, check_same_thread=False)
+        # auto_vacuum 只能在建表之前设置，已有库上是空操作
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="log-store-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    # ----------------------------- 写入 ---------------------------------
+    def append(self, session_id: str, payload: Dict[str, Any], ts: TimeLike = None) -> None:
+        epoch = _to_epoch(ts) if ts is not None else time.time()
+        entry = {
+            "ts": datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None).isoformat(),
+            "session_id": session_id,
+            **payload,
+        }
+        row = (
+            session_id,
+            epoch,
+            payload.get("turn"),
+            payload.get("reward"),
+            payload.get("k"),
+            json.dumps(entry, ensure_ascii=False),
+        )
+        with self._lock:
+            self._buffer.append(row)
+            due = (
+                len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_seconds
+            )
+            if due:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_loop(self) -> None:
+        while not self._closed.wait(self.flush_seconds):
+            with self._lock:
+                if self._conn is None:
+                    return
+                if self._buffer and time.monotonic() - self._last_flush >= self.flush_seconds:
+                    try:
+                        self._flush_locked()
+                    except Exception:  # 后台线程不能因为一次意外就永久退出
+                        logger.exception("background flush of %s failed", self.path)
+
+    def _flush_locked(self) -> None:
+        """
+        写入失败（例如多 worker 争用下 busy_timeout 后仍是 database is locked）时
+        把这批行放回缓冲区等下次重试，只记日志不抛出：日志写不进去不能让对话这一轮失败
+        """
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO turn_logs (session_id, ts, turn, reward, k, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+        except sqlite3.Error:
+            self._buffer = rows + self._buffer
+            logger.exception("writing %d log rows to %s failed, will retry", len(rows), self.path)
+            return
+        self._flushes += 1
+        # 保留策略不必每次都跑，每 64 次落盘检查一次
+        if self._flushes % 64 == 0:
+            try:
+                self._enforce_retention_locked()
+            except sqlite3.Error:
+                logger.exception("enforcing log retention on %s failed", self.path)
+
+    def close(self) -> None:
+        self._closed.set()
+        with self._lock:
+            if self._conn is None:
+                return
+            self._flush_locked()
+            self._conn.close()
+            self._conn = None
+
+    # ----------------------------- 保留 ---------------------------------
+    def enforce_retention(self) -> int:
+        """删掉超龄的行；库还是超过 max_bytes 时再从最老的开始删。返回删除的行数。"""
+        with self._lock:
+            self._flush_locked()
+            return self._enforce_retention_locked()
+
+    def _enforce_retention_locked(self) -> int:
+        deleted = 0
+        with self._conn:
+            if self.retention_days is not None:
+                cutoff = time.time() - self.retention_days * 86400
+                deleted += self._conn.execute("DELETE FROM turn_logs WHERE ts < ?", (cutoff,)).rowcount
+            if self.max_bytes is not None:
+                while self._db_bytes() > self.max_bytes:
+                    cur = self._conn.execute(
+                        "DELETE FROM turn_logs WHERE id IN "
+                        "(SELECT id FROM turn_logs ORDER BY ts LIMIT 1000)"
+                    )
+                    if cur.rowcount == 0:
+                        break
+                    deleted += cur.rowcount
+                    self._conn.execute("PRAGMA incremental_vacuum")
+        if deleted:
+            self._conn.execute("PRAGMA incremental_vacuum")
+        return deleted
+
+    def _db_bytes(self) -> int:
+        page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - freelist) * page_size
+
+    # ----------------------------- 查询 ---------------------------------
+    def _select(
+        self, where: str, params: Tuple, limit: Optional[int], newest: bool = False
+    ) -> List[Dict[str, Any]]:
+        """按时间正序返回；newest=True 时 limit 截取的是最新的那几行，而不是最老的。"""
+        sql = f"SELECT payload FROM turn_logs WHERE {where} ORDER BY ts" + (" DESC" if newest else "")
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = params + (int(limit),)
+        with self._lock:
+            self._flush_locked()
+            rows = self._conn.execute(sql, params).fetchall()
+        if newest:
+            rows.reverse()
+        return [json.loads(payload) for (payload,) in rows]
+
+    @staticmethod
+    def _time_clause(start: TimeLike, end: TimeLike) -> Tuple[str, Tuple]:
+        clauses, params = [], []
+        if start is not None:
+            clauses.append("ts >= ?")
+            params.append(_to_epoch(start))
+        if end is not None:
+            clauses.append("ts < ?")
+            params.append(_to_epoch(end))
+        return " AND ".join(clauses), tuple(params)
+
+    def session_logs(
+        self,
+        session_id: str,
+        start: TimeLike = None,
+        end: TimeLike = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """某个会话的事件（可按时间段截取），按时间排序；给了 limit 时返回最新的 limit 条。"""
+        clause, params = self._time_clause(start, end)
+        where = "session_id = ?" + (f" AND {clause}" if clause else "")
+        return self._select(where, (session_id,) + params, limit, newest=True)
+
+    def range_logs(self, start: TimeLike, end: TimeLike, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """时间段 [start, end) 内所有会话的事件。"""
+        clause, params = self._time_clause(start, end)
+        return self._select(clause or "1 = 1", params, limit)
+
+    def rewards(self, start: TimeLike = None, end: TimeLike = None) -> np.ndarray:
+        """时间段内的 reward 序列，只读索引列，不解析 payload。"""
+        clause, params = self._time_clause(start, end)
+        where = "reward IS NOT NULL" + (f" AND {clause}" if clause else "")
+        with self._lock:
+            self._flush_locked()
+            rows = self._conn.execute(f"SELECT reward FROM turn_logs WHERE {where}", params).fetchall()
+        return np.fromiter((r for (r,) in rows), dtype=float, count=len(rows))
+
+    def reward_histogram(
+        self, start: TimeLike = None, end: TimeLike = None, bins: int = 10
+    ) -> Dict[str, List[float]]:
+        counts, edges = np.histogram(self.rewards(start, end), bins=bins, range=(-1.0, 1.0))
+        return {"counts": counts.tolist(), "edges": edges.tolist()}
+
+
+_default_store: Optional[LogStore] = None
+_default_lock = threading.Lock()
+
+
+def default_log_store() -> LogStore:
+    """进程内共享的默认日志库（logs/turns.db），第一次使用时才打开。"""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = LogStore(Path(__file__).resolve().parent / "logs" / "turns.db")
+        return _default_store
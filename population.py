@@ -0,0 +1,333 @@
+# population.py
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from latent_aligner import LatentAligner
+
+
+class PopulationIndex:
+    """
+    跨会话的群体偏好模型，用已经学到的用户偏好给新会话热启动：
+    - 存每个用户的 w_hat = B θ（N x D，按行预分配，满了倍增扩容）
+    - 共享主方向 P（D x n_basis）：对存量 w 做 SVD 得到，新会话的子空间从这里起步
+    - 在 P 的投影空间里做 k-means，得到倒排表（IVF），每个簇的成员投影连续存放；
+      查询只顺序扫最近的 n_probe 个簇，N 到几十万时单次查询仍在亚毫秒级
+    - 会话学习过程中 upsert 增量刷新：行向量、簇中心、倒排表原地更新；
+      规模较小时存量翻倍自动整体重建，规模大了由后台定期调用 refresh()
+    """
+
+    def __init__(
+        self,
+        D: int,
+        n_basis: int = 8,
+        n_clusters: int = 256,
+        n_probe: int = 2,
+        n_neighbors: int = 16,
+        capacity: int = 1024,
+        auto_refresh_limit: int = 50_000,
+        dtype=np.float32,
+        seed: int = 0,
+    ) -> None:
+        self.D = D
+        self.n_basis = n_basis
+        self.n_clusters = n_clusters
+        self.n_probe = n_probe
+        self.n_neighbors = n_neighbors
+        self.auto_refresh_limit = auto_refresh_limit  # 超过这个规模后不再在 upsert 里自动重建
+        self.dtype = np.dtype(dtype)
+        self.rng = np.random.default_rng(seed)
+
+        self.n = 0
+        self.ids: List[str] = []
+        self.id_to_row: Dict[str, int] = {}
+        self.W = np.zeros((capacity, D), dtype=self.dtype)  # 每行一个用户的 w_hat
+        self.w_sum = np.zeros(D)                            # 所有行之和，用于群体均值
+
+        # 以下在 refresh() 之后才有效
+        self.P: Optional[np.ndarray] = None          # D x n_basis, 共享主方向
+        self.centroids: Optional[np.ndarray] = None  # n_clusters x n_basis
+        self._centroid_sums: Optional[np.ndarray] = None
+        self._counts: Optional[np.ndarray] = None
+        self._assign: Optional[np.ndarray] = None    # 每行所在的簇，-1 表示尚未入簇
+        self._pos: Optional[np.ndarray] = None       # 每行在所在簇倒排表里的位置
+        # 倒排表：每个簇连续存放成员行号和它们的投影，查询时顺序扫描，避免随机访存
+        self._list_rows: List[np.ndarray] = []
+        self._list_Z: List[np.ndarray] = []
+        self._list_sq: List[np.ndarray] = []         # 成员投影的平方范数，距离只需一次矩阵-向量乘
+        self._centroid_sq: Optional[np.ndarray] = None
+        self._n_at_refresh = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    # ----------------------------- 写入 ---------------------------------
+    def get(self, user_id: Optional[str]) -> Optional[np.ndarray]:
+        """取某个用户已存的偏好向量（没有则返回 None）"""
+        row = self.id_to_row.get(user_id) if user_id is not None else None
+        if row is None:
+            return None
+        return self.W[row].copy()
+
+    def add_aligner(self, user_id: str, aligner: LatentAligner) -> None:
+        self.upsert(user_id, aligner.current_approx_pref())
+
+    def load(self, prefs: Iterable[Tuple[str, np.ndarray]]) -> int:
+        """
+        批量写入已存的偏好（例如 AlignerArena.prefs() 给出的各会话 B θ），写完整体重建一次；
+        启动时和定期同步时调用，多个 worker 由此从同一份存量状态得到一致的群体模型。返回写入条数
+        """
+        count = 0
+        limit, self.auto_refresh_limit = self.auto_refresh_limit, -1  # 批量写入期间不反复整体重建
+        try:
+            for user_id, w in prefs:
+                self.upsert(user_id, w)
+                count += 1
+        finally:
+            self.auto_refresh_limit = limit
+        if count:
+            self.refresh()
+        return count
+
+    def adopt(self, other: "PopulationIndex") -> None:
+        """
+        用另一个索引（例如在后台线程里从 arena 重建好的）整体替换自己的内容：
+        只是换引用，持有本对象的会话不用改，调用方几乎不用等
+        """
+        vars(self).update(vars(other))
+
+    def upsert(self, user_id: str, w: np.ndarray) -> None:
+        """写入/更新一个用户的偏好，簇中心与倒排表增量维护"""
+        row = self.id_to_row.get(user_id)
+        if row is None:
+            row = self.n
+            if row >= self.W.shape[0]:
+                self._grow()
+            self.ids.append(user_id)
+            self.id_to_row[user_id] = row
+            self.n += 1
+        else:
+            self.w_sum -= self.W[row]
+
+        self.W[row] = w
+        self.w_sum += self.W[row]
+
+        if self.P is None:
+            if self.n_clusters <= self.n <= self.auto_refresh_limit:
+                self.refresh()
+            return
+        if self.n >= 2 * self._n_at_refresh and self.n <= self.auto_refresh_limit:
+            self.refresh()
+            return
+
+        z = self.P.T @ self.W[row]
+        old = int(self._assign[row])  # 新行为 -1
+        if old >= 0:
+            self._centroid_sums[old] -= self._list_Z[old][self._pos[row]]
+            self._counts[old] -= 1
+        c = int(np.argmin(self._centroid_sq - 2.0 * (self.centroids @ z)))
+        if old != c:
+            if old >= 0:
+                self._list_remove(old, int(self._pos[row]))
+                self._update_centroid(old)
+            self._list_append(c, row)
+        self._list_Z[c][self._pos[row]] = z
+        self._list_sq[c][self._pos[row]] = z @ z
+        self._centroid_sums[c] += z
+        self._counts[c] += 1
+        self._update_centroid(c)
+
+    def _list_append(self, c: int, row: int) -> None:
+        size = int(self._counts[c])  # 调用时 counts 还没加上这一行
+        if size >= len(self._list_rows[c]):
+            cap = max(8, 2 * size)
+            rows = np.empty(cap, dtype=np.int64)
+            rows[:size] = self._list_rows[c][:size]
+            Z = np.empty((cap, self.P.shape[1]), dtype=self.dtype)
+            Z[:size] = self._list_Z[c][:size]
+            sq = np.empty(cap, dtype=self.dtype)
+            sq[:size] = self._list_sq[c][:size]
+            self._list_rows[c], self._list_Z[c], self._list_sq[c] = rows, Z, sq
+        self._list_rows[c][size] = row
+        self._assign[row] = c
+        self._pos[row] = size
+
+    def _list_remove(self, c: int, pos: int) -> None:
+        """把最后一个成员挪到 pos 上填空（调用时 counts 已经减掉这一行）"""
+        last = int(self._counts[c])
+        if pos != last:
+            moved = int(self._list_rows[c][last])
+            self._list_rows[c][pos] = moved
+            self._list_Z[c][pos] = self._list_Z[c][last]
+            self._list_sq[c][pos] = self._list_sq[c][last]
+            self._pos[moved] = pos
+
+    def _update_centroid(self, c: int) -> None:
+        if self._counts[c] > 0:
+            self.centroids[c] = self._centroid_sums[c] / self._counts[c]
+            self._centroid_sq[c] = self.centroids[c] @ self.centroids[c]
+
+    def _grow(self) -> None:
+        cap = self.W.shape[0] * 2
+        W = np.zeros((cap, self.D), dtype=self.dtype)
+        W[: self.n] = self.W[: self.n]
+        self.W = W
+        if self.P is not None:
+            assign = np.full(cap, -1, dtype=np.int64)
+            assign[: self.n] = self._assign[: self.n]
+            pos = np.zeros(cap, dtype=np.int64)
+            pos[: self.n] = self._pos[: self.n]
+            self._assign, self._pos = assign, pos
+
+    # ----------------------------- 重建 ---------------------------------
+    def refresh(self, n_iter: int = 10, max_sample: int = 50000) -> None:
+        """
+        整体重建：
+        - 对（抽样的）存量 w 做 SVD，取前 n_basis 个右奇异向量作为共享主方向 P
+        - 在投影空间里跑几轮 k-means，再把全部行分到最近的簇，重建倒排表
+        """
+        n = self.n
+        if n == 0:
+            return
+        W = self.W[:n]
+        sample = W if n <= max_sample else W[self.rng.choice(n, max_sample, replace=False)]
+
+        # 不去中心化：主方向同时覆盖群体均值和用户间差异
+        Vt = self._top_right_singular(sample, self.n_basis)
+        self.P = np.ascontiguousarray(Vt.T, dtype=self.dtype)
+
+        Z = W @ self.P
+
+        n_clusters = min(self.n_clusters, n)
+        Zs = Z if n <= max_sample else Z[self.rng.choice(n, max_sample, replace=False)]
+        centroids = Zs[self.rng.choice(Zs.shape[0], n_clusters, replace=False)].copy()
+        for _ in range(n_iter):
+            labels = self._nearest_centroids(Zs, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, Zs)
+            counts = np.bincount(labels, minlength=n_clusters)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+        labels = self._nearest_centroids(Z, centroids)
+        cap = self.W.shape[0]
+        self._assign = np.full(cap, -1, dtype=np.int64)
+        self._assign[:n] = labels
+        self._pos = np.zeros(cap, dtype=np.int64)
+        self._centroid_sums = np.zeros_like(centroids)
+        np.add.at(self._centroid_sums, labels, Z)
+        self._counts = np.bincount(labels, minlength=n_clusters)
+        self.centroids = centroids
+        self._centroid_sq = np.zeros(n_clusters, dtype=centroids.dtype)
+        for c in range(n_clusters):
+            self._update_centroid(c)
+
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(n_clusters + 1))
+        self._list_rows, self._list_Z, self._list_sq = [], [], []
+        Z_sq = np.einsum("ij,ij->i", Z, Z)
+        for c in range(n_clusters):
+            members = order[bounds[c] : bounds[c + 1]]
+            self._pos[members] = np.arange(members.size)
+            self._list_rows.append(members.copy())
+            self._list_Z.append(Z[members])
+            self._list_sq.append(Z_sq[members])
+        self._n_at_refresh = n
+
+    def _top_right_singular(
+        self, X: np.ndarray, n: int, oversample: int = 10, n_power: int = 4
+    ) -> np.ndarray:
+        """
+        X 的前 n 个右奇异向量（n x D）：
+        - 矩阵小的时候直接做精确 SVD
+        - D 是句向量尺度时，完整 SVD 要算 min(N, D) 个奇异向量，太慢；
+          改用随机化 SVD（随机投影 + 幂迭代 + 小矩阵 SVD），只做 N x D 乘法，
+          不构造 D x D 或 N x N 的矩阵
+        """
+        X = X.astype(float)
+        rank = n + oversample
+        if min(X.shape) <= 8 * rank:
+            _, _, Vt = np.linalg.svd(X, full_matrices=False)
+            return Vt[: min(n, Vt.shape[0])]
+        Q, _ = np.linalg.qr(X @ self.rng.standard_normal((X.shape[1], rank)))
+        for _ in range(n_power):
+            Q, _ = np.linalg.qr(X.T @ Q)
+            Q, _ = np.linalg.qr(X @ Q)
+        _, _, Vt = np.linalg.svd(Q.T @ X, full_matrices=False)
+        return Vt[:n]
+
+    @staticmethod
+    def _nearest_centroids(Z: np.ndarray, centroids: np.ndarray, chunk: int = 65536) -> np.ndarray:
+        c_sq = np.sum(np.square(centroids), axis=1)
+        labels = np.empty(Z.shape[0], dtype=np.int64)
+        for start in range(0, Z.shape[0], chunk):
+            part = Z[start : start + chunk]
+            # 同 lookup：||z||^2 不影响 argmin
+            labels[start : start + chunk] = np.argmin(c_sq - 2.0 * part @ centroids.T, axis=1)
+        return labels
+
+    # ----------------------------- 查询 ---------------------------------
+    def mean_pref(self) -> Optional[np.ndarray]:
+        if self.n == 0:
+            return None
+        return self.w_sum / self.n
+
+    def lookup(self, query: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+        """
+        返回给新会话用的先验偏好向量：
+        - 没有 query（全新用户、毫无线索）→ 群体均值
+        - 有 query → 最近的 n_neighbors 个已存用户的 w 均值
+        """
+        if self.n == 0:
+            return None
+        if query is None:
+            return self.mean_pref()
+
+        q = np.asarray(query, dtype=self.dtype)
+        if self.P is None:
+            # 存量还少，直接全量暴力搜
+            rows = np.arange(self.n)
+            d = np.sum(np.square(self.W[: self.n] - q), axis=1)
+        else:
+            z = self.P.T @ q
+            # ||x - z||^2 = ||x||^2 - 2 x·z + ||z||^2，最后一项不影响排序
+            d_c = self._centroid_sq - 2.0 * (self.centroids @ z)
+            probe = np.argpartition(d_c, min(self.n_probe, len(d_c) - 1))[: self.n_probe]
+            sizes = [int(self._counts[c]) for c in probe]
+            rows = np.concatenate([self._list_rows[c][:m] for c, m in zip(probe, sizes)])
+            if rows.size == 0:
+                return self.mean_pref()
+            Zp = np.concatenate([self._list_Z[c][:m] for c, m in zip(probe, sizes)])
+            sq = np.concatenate([self._list_sq[c][:m] for c, m in zip(probe, sizes)])
+            d = sq - 2.0 * (Zp @ z)
+
+        k = min(self.n_neighbors, rows.size)
+        nearest = rows[np.argpartition(d, k - 1)[:k]]
+        return self.W[nearest].mean(axis=0, dtype=float)
+
+    def warm_start(
+        self,
+        aligner: LatentAligner,
+        query: Optional[np.ndarray] = None,
+        k: Optional[int] = None,
+        prior: Optional[np.ndarray] = None,
+    ) -> bool:
+        """
+        用群体模型初始化一个新对齐器的 B 和 θ：
+        - 先验偏好：给了 prior（例如老用户自己存过的 w）就直接用，否则用 lookup(query)
+        - 第一列取先验偏好方向，其余列取群体主方向（还没有主方向时沿用对齐器自己的随机基）
+        - θ0 = B^T w_prior，使 B θ0 恰好等于先验偏好
+        """
+        if prior is None:
+            prior = self.lookup(query)
+        if prior is None:
+            return False
+
+        k = min(k or aligner.k_init, aligner.k_max, aligner.D)
+        basis = self.P if self.P is not None else aligner.B
+        if np.linalg.norm(prior) > 1e-6:
+            cols = np.column_stack([prior, basis[:, : k - 1]])
+        else:
+            cols = basis[:, :k]
+        B0, _ = np.linalg.qr(cols.astype(float))
+        aligner.warm_start(B0, B0.T @ prior)
+        return True
@@ -0,0 +1,252 @@
+"""Low-overhead sampling profiler and slow-turn tracer, tagged by session and turn stage."""
+from __future__ import annotations
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from config import PROFILE_INTERVAL_MS, PROFILE_MAX_DEPTH
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}.{code.co_name}:{code.co_firstlineno}"
+
+
+class TurnProfiler:
+    """
+    生产环境里定位“这一轮慢在哪”：
+    - stage()：handle_message 的各个阶段（reward 估计、对齐器更新、回复生成、日志、广播……）
+      用它给当前线程打上 (session_id, 阶段) 标签，并记录阶段耗时，空闲时几乎没有开销
+    - 采样器：后台线程每隔 interval 秒抓一次所有线程的调用栈，按标签聚合成
+      flamegraph 的 collapsed 格式，跑满 N 秒或 N 轮后自动停止
+    - 慢轮追踪：arm_slow_turn 之后每轮都在 cProfile 下跑，第一轮超过阈值的完整
+      函数级统计和阶段耗时被保存下来，然后自动解除
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000, max_depth: int = PROFILE_MAX_DEPTH) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        # 线程 id -> (session_id, 阶段)，采样线程据此给栈打标签
+        self._tags: Dict[int, Tuple[str, str]] = {}
+        self._turns = threading.local()
+
+        self._sampler: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._deadline: Optional[float] = None
+        self._turns_left: Optional[int] = None
+        self._started_at: Optional[float] = None
+        self._stopped_at: Optional[float] = None
+        self._stacks: Counter = Counter()
+        self._samples = 0
+
+        self._slow_threshold: Optional[float] = None
+        self._slow_turn: Optional[Dict[str, Any]] = None
+
+    # ----------------------------- 标签 / 轮次 ---------------------------------
+    @contextmanager
+    def stage(self, session_id: str, name: str) -> Iterator[None]:
+        tid = threading.get_ident()
+        previous = self._tags.get(tid)
+        self._tags[tid] = (session_id, name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings = getattr(self._turns, "timings", None)
+            if timings is not None:
+                timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+            if previous is None:
+                self._tags.pop(tid, None)
+            else:
+                self._tags[tid] = previous
+
+    @contextmanager
+    def turn(self, session_id: str, turn: int) -> Iterator[None]:
+        """包住一整轮：统计阶段耗时、按需跑 cProfile、给“跑 N 轮”的采样计数。可以嵌套，只有最外层生效。"""
+        if getattr(self._turns, "timings", None) is not None:
+            yield
+            return
+        self._turns.timings = {}
+        trace = cProfile.Profile() if self._slow_threshold is not None else None
+        start = time.perf_counter()
+        if trace is not None:
+            try:
+                trace.enable()
+            except ValueError:  # 另一个 profiler 已经在这个线程上运行
+                trace = None
+        try:
+            with self.stage(session_id, "turn"):
+                yield
+        finally:
+            if trace is not None:
+                trace.disable()
+            elapsed = time.perf_counter() - start
+            timings, self._turns.timings = self._turns.timings, None
+            if trace is not None:
+                self._maybe_keep_slow_turn(trace, session_id, turn, elapsed, timings)
+            self._turn_finished()
+
+    # ----------------------------- 采样器 ---------------------------------
+    def start(
+        self,
+        seconds: Optional[float] = None,
+        turns: Optional[int] = None,
+        interval: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """开始采样（清掉上一次的结果）；seconds / turns 都不给时一直跑到 stop()。"""
+        with self._lock:
+            if self.running:
+                raise RuntimeError("profiler is already running")
+            if interval is not None:
+                self.interval = interval
+            self._stacks = Counter()
+            self._samples = 0
+            self._started_at = time.time()
+            self._stopped_at = None
+            self._deadline = time.monotonic() + seconds if seconds is not None else None
+            self._turns_left = turns
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._run, name="turn-profiler", daemon=True)
+            self._sampler.start()
+        return self.status()
+
+    def stop(self) -> Dict[str, Any]:
+        self._stop.set()
+        sampler = self._sampler
+        if sampler is not None and sampler is not threading.current_thread():
+            sampler.join()
+        return self.result()
+
+    @property
+    def running(self) -> bool:
+        return self._sampler is not None and self._sampler.is_alive()
+
+    def _turn_finished(self) -> None:
+        with self._lock:
+            if self._turns_left is None or not self.running:
+                return
+            self._turns_left -= 1
+            if self._turns_left <= 0:
+                self._stop.set()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                break
+            frames = sys._current_frames()
+            for tid, frame in frames.items():
+                if tid == own:
+                    continue
+                session_id, stage = self._tags.get(tid, ("-", "idle"))
+                self._stacks[(session_id, stage, self._collect(frame))] += 1
+            self._samples += 1
+        self._stopped_at = time.time()
+
+    def _collect(self, frame) -> Tuple[str, ...]:
+        stack: List[str] = []
+        while frame is not None and len(stack) < self.max_depth:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "interval_ms": self.interval * 1000,
+            "started_at": self._started_at,
+            "stopped_at": self._stopped_at,
+            "samples": self._samples,
+            "turns_left": self._turns_left,
+            "slow_turn_threshold_ms": None if self._slow_threshold is None else self._slow_threshold * 1000,
+        }
+
+    def result(self, top: int = 50, include_idle: bool = False) -> Dict[str, Any]:
+        """
+        聚合结果：
+        - by_stage / by_session：样本数，乘 interval 约等于耗时
+        - stacks：最热的 top 条调用栈
+        - collapsed：flamegraph.pl / speedscope 可直接读的 collapsed 格式，
+          栈底是 "session_id;阶段"
+        """
+        stacks = dict(self._stacks)
+        by_stage: Counter = Counter()
+        by_session: Counter = Counter()
+        collapsed: Counter = Counter()
+        for (session_id, stage, stack), count in stacks.items():
+            if stage == "idle" and not include_idle:
+                continue
+            by_stage[stage] += count
+            by_session[session_id] += count
+            collapsed[";".join((session_id, stage) + stack)] += count
+        return {
+            **self.status(),
+            "by_stage": dict(by_stage.most_common()),
+            "by_session": dict(by_session.most_common()),
+            "stacks": [{"stack": line.split(";"), "count": count} for line, count in collapsed.most_common(top)],
+            "collapsed": "\n".join(f"{line} {count}" for line, count in collapsed.most_common()),
+        }
+
+    # ----------------------------- 慢轮追踪 ---------------------------------
+    def arm_slow_turn(self, threshold_ms: float) -> None:
+        """下一轮耗时超过 threshold_ms 时保存完整追踪（之前保存的那份会被清掉）。"""
+        with self._lock:
+            self._slow_threshold = threshold_ms / 1000
+            self._slow_turn = None
+
+    def disarm_slow_turn(self) -> None:
+        with self._lock:
+            self._slow_threshold = None
+
+    @property
+    def slow_turn(self) -> Optional[Dict[str, Any]]:
+        return self._slow_turn
+
+    def _maybe_keep_slow_turn(
+        self,
+        trace: cProfile.Profile,
+        session_id: str,
+        turn: int,
+        elapsed: float,
+        timings: Dict[str, float],
+        top: int = 40,
+    ) -> None:
+        with self._lock:
+            if self._slow_threshold is None or elapsed < self._slow_threshold:
+                return
+            self._slow_threshold = None
+        out = io.StringIO()
+        stats = pstats.Stats(trace, stream=out)
+        stats.sort_stats("cumulative").print_stats(top)
+        functions = [
+            {
+                "function": f"{path}:{line}({name})",
+                "calls": nc,
+                "total_ms": tt * 1000,
+                "cumulative_ms": ct * 1000,
+            }
+            for (path, line, name), (_, nc, tt, ct, _) in stats.stats.items()
+        ]
+        functions.sort(key=lambda f: f["cumulative_ms"], reverse=True)
+        self._slow_turn = {
+            "session_id": session_id,
+            "turn": turn,
+            "captured_at": time.time(),
+            "elapsed_ms": elapsed * 1000,
+            "stages_ms": {name: seconds * 1000 for name, seconds in timings.items()},
+            "functions": functions[:top],
+            "report": out.getvalue(),
+        }
+
+
+profiler = TurnProfiler()
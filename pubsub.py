@@ -0,0 +1,351 @@
+"""Pluggable pub/sub used to fan state-change events out to every worker's WebSocket subscribers."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+Handler = Callable[[str, str], None]
+
+logger = logging.getLogger(__name__)
+
+_MAX_DATAGRAM = 1 << 20
+
+
+class PubSub(ABC):
+    """
+    发布 / 订阅的公共接口：
+    - publish(key, payload)：发布一条事件，key 一般是 session_id，payload 是已经序列化好的 JSON
+    - subscribe(handler)：注册回调 handler(key, payload)，本 worker 收到任何事件（包括自己发的）都会调用
+    后端可能在后台线程里调用 handler，handler 需要自己切回事件循环（见 CoalescingFanout）。
+    """
+
+    def __init__(self, channel: str) -> None:
+        self.channel = channel
+        self._handlers: List[Handler] = []
+
+    def subscribe(self, handler: Handler) -> None:
+        self._handlers.append(handler)
+
+    def unsubscribe(self, handler: Handler) -> None:
+        if handler in self._handlers:
+            self._handlers.remove(handler)
+
+    @abstractmethod
+    def publish(self, key: str, payload: str) -> None:
+        """发布一条事件。"""
+
+    def close(self) -> None:
+        pass
+
+    def _dispatch(self, key: str, payload: str) -> None:
+        for handler in list(self._handlers):
+            try:
+                handler(key, payload)
+            except Exception:
+                logger.exception("pubsub handler failed")
+
+    # key 不含换行，用第一个换行把 key 和 payload 拼成一条消息
+    @staticmethod
+    def _encode(key: str, payload: str) -> bytes:
+        if "\n" in key:
+            raise ValueError(f"pubsub key 不能包含换行: {key!r}")
+        return f"{key}\n{payload}".encode("utf-8")
+
+    @staticmethod
+    def _decode(data: bytes) -> Tuple[str, str]:
+        key, _, payload = data.decode("utf-8").partition("\n")
+        return key, payload
+
+
+class LocalPubSub(PubSub):
+    """进程内后端（默认）：publish 直接同步调用本进程的订阅者。"""
+
+    def publish(self, key: str, payload: str) -> None:
+        self._encode(key, payload)  # 与其他后端保持同样的 key 校验
+        self._dispatch(key, payload)
+
+
+class SocketPubSub(PubSub):
+    """
+    同一台机器上多个 worker 之间的后端，不需要额外服务：
+    - 每个 worker 在 directory/<channel>/ 下绑定一个 Unix datagram socket
+    - publish 把消息发给目录里的每个 socket（包括自己），一条事件一次 sendto
+    - 发送是非阻塞的：某个 worker 的接收缓冲满了就丢掉这条（下一次状态变化会覆盖），
+      连不上的 socket 视为已退出的 worker，直接删掉
+    """
+
+    def __init__(self, directory: Union[str, Path], channel: str) -> None:
+        super().__init__(channel)
+        self.directory = Path(directory) / channel
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock"
+
+        self._recv = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._recv.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _MAX_DATAGRAM)
+        self._recv.bind(str(self.path))
+        self._send = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._send.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _MAX_DATAGRAM)
+        self._send.setblocking(False)
+        self._send_lock = threading.Lock()
+
+        self._closed = False
+        self._thread = threading.Thread(target=self._reader, name="pubsub-socket", daemon=True)
+        self._thread.start()
+
+    def publish(self, key: str, payload: str) -> None:
+        data = self._encode(key, payload)
+        with self._send_lock:
+            for peer in self.directory.glob("*.sock"):
+                try:
+                    self._send.sendto(data, str(peer))
+                except (ConnectionRefusedError, FileNotFoundError):
+                    peer.unlink(missing_ok=True)
+                except BlockingIOError:
+                    logger.warning("pubsub peer %s is not keeping up, dropping event", peer.name)
+                except OSError as exc:
+                    logger.warning("pubsub send to %s failed: %s", peer.name, exc)
+
+    def _reader(self) -> None:
+        while not self._closed:
+            try:
+                data = self._recv.recv(_MAX_DATAGRAM)
+            except OSError:
+                break
+            if data:
+                self._dispatch(*self._decode(data))
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self.path.unlink(missing_ok=True)
+        # 关闭前先 shutdown，让阻塞在 recv 上的读线程退出
+        try:
+            self._recv.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._recv.close()
+        self._send.close()
+
+
+class _RespConnection:
+    """最小的 RESP（Redis 协议）客户端连接：只支持发命令和读回复。"""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        password: Optional[str],
+        db: int,
+        timeout: Optional[float],
+        io_timeout: Optional[float] = None,
+    ) -> None:
+        """timeout 用于建连；io_timeout 用于之后的收发，None 表示一直阻塞（只适合订阅连接）。"""
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.settimeout(io_timeout)
+        self._reader = self.sock.makefile("rb")
+        if password:
+            self.call("AUTH", password)
+        if db:
+            self.call("SELECT", str(db))
+
+    def send(self, *args: Union[str, bytes]) -> None:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            raw = arg if isinstance(arg, bytes) else arg.encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(raw), raw))
+        self.sock.sendall(b"".join(parts))
+
+    def read(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RuntimeError(f"redis error: {rest.decode()}")
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = self._reader.read(size + 2)
+            return data[:-2]
+        if kind == b"*":
+            size = int(rest)
+            return None if size < 0 else [self.read() for _ in range(size)]
+        raise ConnectionError(f"unexpected RESP reply: {line!r}")
+
+    def call(self, *args: Union[str, bytes]):
+        self.send(*args)
+        return self.read()
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisPubSub(PubSub):
+    """
+    跨机器的后端，走 Redis 的 PUBLISH / SUBSCRIBE：
+    - 直接说 RESP 协议，不依赖 redis-py；任何兼容 RESP 的服务（或本地替身）都能用
+    - 发布和订阅各用一条连接，订阅连接在后台线程里读，断线后按退避重连
+    - 发布连接的收发也有 timeout，服务端卡住时 publish 最多阻塞几个 timeout；
+      失败后 reconnect_seconds 内的发布直接报错，不再每次都等超时
+    """
+
+    def __init__(self, url: str, channel: str, timeout: float = 2.0, reconnect_seconds: float = 1.0) -> None:
+        super().__init__(channel)
+        parsed = urlparse(url)
+        if parsed.scheme not in ("redis", ""):
+            raise ValueError(f"不支持的 pubsub 地址: {url}")
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.reconnect_seconds = reconnect_seconds
+
+        self._pub: Optional[_RespConnection] = None
+        self._pub_lock = threading.Lock()
+        self._pub_retry_at = 0.0
+        self._sub: Optional[_RespConnection] = None
+        self._subscribed = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._reader, name="pubsub-redis", daemon=True)
+        self._thread.start()
+
+    def _connect(self, io_timeout: Optional[float] = None) -> _RespConnection:
+        return _RespConnection(self.host, self.port, self.password, self.db, self.timeout, io_timeout)
+
+    def publish(self, key: str, payload: str) -> None:
+        data = self._encode(key, payload)
+        with self._pub_lock:
+            if self._pub is None and time.monotonic() < self._pub_retry_at:
+                raise ConnectionError("redis is unavailable, waiting before reconnecting")
+            # 连接断了就重连一次再发，还失败就把异常抛给调用方
+            for attempt in range(2):
+                try:
+                    if self._pub is None:
+                        self._pub = self._connect(io_timeout=self.timeout)
+                    self._pub.call("PUBLISH", self.channel, data)
+                    return
+                except (OSError, ConnectionError):
+                    if self._pub is not None:
+                        self._pub.close()
+                        self._pub = None
+                    if attempt:
+                        self._pub_retry_at = time.monotonic() + self.reconnect_seconds
+                        raise
+
+    def wait_subscribed(self, timeout: Optional[float] = None) -> bool:
+        """订阅连接建好之前发布的事件本 worker 收不到，需要时可以先等一下。"""
+        return self._subscribed.wait(timeout)
+
+    def _reader(self) -> None:
+        while not self._closed:
+            try:
+                self._sub = self._connect()
+                self._sub.call("SUBSCRIBE", self.channel)
+                self._subscribed.set()
+                while not self._closed:
+                    reply = self._sub.read()
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        self._dispatch(*self._decode(reply[2]))
+            except (OSError, ConnectionError, RuntimeError) as exc:
+                self._subscribed.clear()
+                if self._closed:
+                    break
+                logger.warning("pubsub subscription lost (%s), reconnecting", exc)
+                time.sleep(self.reconnect_seconds)
+            finally:
+                if self._sub is not None:
+                    self._sub.close()
+                    self._sub = None
+
+    def close(self) -> None:
+        self._closed = True
+        if self._sub is not None:
+            try:
+                self._sub.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        with self._pub_lock:
+            if self._pub is not None:
+                self._pub.close()
+                self._pub = None
+
+
+def make_pubsub(backend: str, url: Optional[str] = None, channel: str = "aligner-state") -> PubSub:
+    """按配置创建后端："local" / "socket"（url 为 socket 目录）/ "redis"（url 为 redis://host:port/db）。"""
+    if backend == "local":
+        return LocalPubSub(channel)
+    if backend == "socket":
+        return SocketPubSub(url or Path(__file__).resolve().parent / "state" / "pubsub", channel)
+    if backend == "redis":
+        return RedisPubSub(url or "redis://127.0.0.1:6379/0", channel)
+    raise ValueError(f"unknown pubsub backend: {backend}")
+
+
+class CoalescingFanout:
+    """
+    把事件合并后交给 send(batch)：
+    - 同一个 key 在一个间隔内的多次更新只保留最新一条
+    - 安静一段时间后的第一条事件立即发出，之后最多每 interval 秒发一批
+    offer() 可以从任意线程调用，合并和发送都在事件循环里完成。
+    """
+
+    def __init__(
+        self,
+        send: Callable[[Dict[str, str]], Awaitable[None]],
+        interval: float,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ) -> None:
+        self.send = send
+        self.interval = interval
+        self.loop = loop
+        self._pending: Dict[str, str] = {}
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._last_flush = float("-inf")
+        self.received = 0
+        self.delivered = 0
+
+    def offer(self, key: str, payload: str) -> None:
+        if self.loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._offer(key, payload)
+        else:
+            self.loop.call_soon_threadsafe(self._offer, key, payload)
+
+    def _offer(self, key: str, payload: str) -> None:
+        self.received += 1
+        self._pending[key] = payload
+        if self._handle is None:
+            delay = max(0.0, self._last_flush + self.interval - self.loop.time())
+            self._handle = self.loop.call_later(delay, self._flush)
+
+    def _flush(self) -> None:
+        self._handle = None
+        self._last_flush = self.loop.time()
+        batch, self._pending = self._pending, {}
+        if batch:
+            self.delivered += len(batch)
+            self.loop.create_task(self.send(batch))
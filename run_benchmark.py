@@ -0,0 +1,315 @@
+# run_benchmark.py
+import time
+import tracemalloc
+
+import numpy as np
+
+from config import (
+    D_REAL,
+    INIT_K,
+    MAX_K,
+    COMPACT_K,
+    NOISE_STD,
+    LAMBDA_RIDGE,
+    WINDOW,
+    ERR_THRESH,
+    T_STEPS,
+    SEED,
+    TARGET_COS,
+    WARM_START_K,
+    POP_BASIS,
+    POP_CLUSTERS,
+    ALIGNER_DTYPE,
+)
+from user_env import UserEnv
+from latent_aligner import LatentAligner
+from population import PopulationIndex
+from run_simulation import make_aligner
+from llm_bridge import compress_action
+
+SCALE_DIMS = (D_REAL, 768, 1536, 4096)
+
+
+def bench_turns(
+    dtype=np.float64, steps: int = 2000, expand_every: int = 50, D: int = D_REAL, k_max: int = MAX_K
+) -> dict:
+    """
+    跑 steps 轮 sample_action → step → update_with_sample，
+    统计每轮耗时、sample_action / update_with_sample 各自的临时堆内存
+    （tracemalloc 峰值 - 调用前占用），以及对齐器常驻的数组字节数。
+    """
+    rng = np.random.default_rng(SEED)
+    user = UserEnv.random(dim=D, noise_std=NOISE_STD, rng=rng, dtype=dtype)
+    aligner = LatentAligner(
+        D=D, k_init=INIT_K, k_max=k_max, lam=LAMBDA_RIDGE, rng=rng, dtype=dtype
+    )
+
+    def traced(fn, *args):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        out = fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        return out, peak - before
+
+    def run(n: int, trace: bool) -> list:
+        transient = []
+        for t in range(n):
+            if trace:
+                a, sample_bytes = traced(aligner.sample_action)
+                r = user.step(a)
+                _, update_bytes = traced(aligner.update_with_sample, a, r)
+                transient.append((sample_bytes, update_bytes))
+            else:
+                a = aligner.sample_action()
+                r = user.step(a)
+                aligner.update_with_sample(a, r)
+            if (t + 1) % expand_every == 0 and aligner.k < aligner.k_max:
+                aligner.expand_subspace()
+        return transient
+
+    # 先计时（不开 tracemalloc，避免其开销污染耗时），再统计内存
+    t0 = time.perf_counter()
+    run(steps, trace=False)
+    elapsed = time.perf_counter() - t0
+    tracemalloc.start()
+    transient = run(steps // 4, trace=True)
+    tracemalloc.stop()
+
+    return {
+        "k": aligner.k,
+        "us_per_turn": elapsed / steps * 1e6,
+        "sample_bytes": float(np.mean([s for s, _ in transient])),
+        "update_bytes": float(np.mean([u for _, u in transient])),
+        "bytes_per_aligner": aligner.nbytes,
+    }
+
+
+def bench_batch(n: int = 10_000) -> dict:
+    """update_with_batch 与逐个 update_with_sample 的耗时与结果差异。"""
+    rng = np.random.default_rng(SEED)
+    actions = rng.normal(0, 1, size=(n, D_REAL))
+    rewards = rng.uniform(-1, 1, size=n)  # 与线上 reward 同一取值范围
+    seq = LatentAligner(D=D_REAL, k_init=MAX_K, k_max=MAX_K, lam=LAMBDA_RIDGE, rng=np.random.default_rng(SEED))
+    bat = LatentAligner(D=D_REAL, k_init=MAX_K, k_max=MAX_K, lam=LAMBDA_RIDGE, rng=np.random.default_rng(SEED))
+    t0 = time.perf_counter()
+    for a, r in zip(actions, rewards):
+        seq.update_with_sample(a, float(r))
+    seq_ms = (time.perf_counter() - t0) * 1e3
+    t0 = time.perf_counter()
+    bat.update_with_batch(actions, rewards)
+    bat_ms = (time.perf_counter() - t0) * 1e3
+    return {
+        "seq_ms": seq_ms,
+        "batch_ms": bat_ms,
+        "max_theta_diff": float(np.max(np.abs(seq.theta - bat.theta))),
+    }
+
+
+def cos_sim(u: np.ndarray, v: np.ndarray) -> float:
+    return float(np.dot(u, v) / (np.linalg.norm(u) * np.linalg.norm(v) + 1e-9))
+
+
+def bench_compaction(k_max: int, compact_to=None, steps: int = 2 * T_STEPS, seeds: int = 5) -> dict:
+    """
+    模拟合成用户，每 WINDOW 步尝试一次升维（满了就按 compact_to 压缩），
+    比较最终 cos(w_hat, w_true) 与每轮耗时。
+    """
+    cos_list, us_list, k_list = [], [], []
+    for s in range(seeds):
+        np.random.seed(SEED + s)  # UserEnv.step 的噪声走全局随机数
+        rng = np.random.default_rng(SEED + s)
+        user = UserEnv.random(dim=D_REAL, noise_std=NOISE_STD, rng=rng)
+        aligner = LatentAligner(D=D_REAL, k_init=INIT_K, k_max=k_max, lam=LAMBDA_RIDGE, rng=rng)
+        turn_time = 0.0
+        for t in range(steps):
+            t0 = time.perf_counter()
+            a = aligner.sample_action()
+            r = user.step(a)
+            aligner.update_with_sample(a, r)
+            turn_time += time.perf_counter() - t0
+            if (t + 1) % WINDOW == 0:
+                aligner.expand_subspace(compact_to=compact_to)
+        cos_list.append(cos_sim(aligner.current_approx_pref(), user.true_pref()))
+        us_list.append(turn_time / steps * 1e6)
+        k_list.append(aligner.k)
+    return {
+        "cos": float(np.mean(cos_list)),
+        "us_per_turn": float(np.mean(us_list)),
+        "final_k": float(np.mean(k_list)),
+    }
+
+
+def synthetic_population(
+    n: int, draw_seed: int = 0, n_styles: int = 6, spread: float = 0.5, D: int = D_REAL
+) -> np.ndarray:
+    """几种主流风格（固定）+ 个体差异（随 draw_seed 变化），模拟真实用户偏好的聚团分布。"""
+    styles = np.random.default_rng(SEED).normal(0, 1, size=(n_styles, D))
+    styles /= np.linalg.norm(styles, axis=1, keepdims=True)
+    rng = np.random.default_rng(SEED + 1 + draw_seed)
+    W = styles[rng.integers(0, n_styles, n)] + spread * rng.normal(0, 1, size=(n, D)) / np.sqrt(D)
+    return W / np.linalg.norm(W, axis=1, keepdims=True)
+
+
+def bench_population(n_users: int = 300_000, n_lookups: int = 2000) -> dict:
+    """群体索引：逐个 upsert 的耗时、整体 refresh 耗时、查询延迟。"""
+    W = synthetic_population(n_users)
+    pop = PopulationIndex(D_REAL, n_basis=POP_BASIS, n_clusters=POP_CLUSTERS)
+    t0 = time.perf_counter()
+    for i in range(n_users):
+        pop.upsert(f"user{i}", W[i])
+    insert_us = (time.perf_counter() - t0) / n_users * 1e6
+    t0 = time.perf_counter()
+    pop.refresh()
+    refresh_s = time.perf_counter() - t0
+
+    rng = np.random.default_rng(SEED)
+    lat = []
+    for q in W[rng.integers(0, n_users, n_lookups)]:
+        t0 = time.perf_counter()
+        pop.lookup(q)
+        lat.append(time.perf_counter() - t0)
+    lat_us = np.array(lat) * 1e6
+    return {
+        "pop": pop,
+        "insert_us": insert_us,
+        "refresh_s": refresh_s,
+        "lookup_p50_us": float(np.percentile(lat_us, 50)),
+        "lookup_p99_us": float(np.percentile(lat_us, 99)),
+    }
+
+
+def turns_to_target_warm(
+    pop, w_true: np.ndarray, seed: int, warm: bool, query=None, k_max: int = MAX_K, dtype=ALIGNER_DTYPE, warm_k: int = WARM_START_K
+):
+    """
+    与 run_simulation 相同的升维规则，返回首次 cos >= TARGET_COS 的轮数（没达到为 None）。
+    热启动且没有 query 时与 ConversationSession 一致：先用群体均值，学够 WINDOW 轮后换成近邻均值
+    """
+    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
+    user = UserEnv(w_true=w_true.astype(dtype), noise_std=NOISE_STD)
+    aligner = make_aligner(rng, D=len(w_true), k_max=k_max, dtype=dtype)
+    prior = None
+    if warm:
+        prior = pop.lookup(query)
+        pop.warm_start(aligner, k=warm_k, prior=prior)
+    refine = warm and query is None and prior is not None
+
+    recent_errors = []
+    for t in range(T_STEPS):
+        if cos_sim(aligner.current_approx_pref(), w_true) >= TARGET_COS:
+            return t
+        a = aligner.sample_action()
+        r = user.step(a)
+        e, _ = aligner.update_with_sample(a, r)
+        recent_errors.append(e)
+        if refine and t + 1 == WINDOW:
+            aligner.shift_prior(pop.lookup(aligner.current_approx_pref()) - prior)
+        if (t + 1) % WINDOW == 0 and np.mean(np.square(recent_errors[-WINDOW:])) > ERR_THRESH:
+            aligner.expand_subspace(compact_to=COMPACT_K)
+    return None
+
+
+def bench_convergence_at_scale(D: int, n_users: int = 5000, n_new: int = 20, dtype=np.float32) -> dict:
+    """
+    句向量尺度的 D 下，新用户从冷启动 / 群体热启动（用满 POP_BASIS 个主方向）
+    到达 cos ≥ TARGET_COS 需要的轮数。
+    """
+    W = synthetic_population(n_users, D=D)
+    pop = PopulationIndex(D, n_basis=POP_BASIS, n_clusters=min(POP_CLUSTERS, n_users // 50))
+    t0 = time.perf_counter()
+    for i in range(n_users):
+        pop.upsert(f"user{i}", W[i])
+    build_s = time.perf_counter() - t0
+
+    new_users = synthetic_population(n_new, draw_seed=1, D=D)
+    out = {"build_s": build_s}
+    for label, warm in (("cold", False), ("warm", True)):
+        hits = [
+            turns_to_target_warm(pop, w, SEED + i, warm, dtype=dtype, warm_k=POP_BASIS)
+            for i, w in enumerate(new_users)
+        ]
+        reached = [h for h in hits if h is not None]
+        out[label] = (len(reached), float(np.median(reached)) if reached else None)
+    return out
+
+
+def main():
+    print(f"D={D_REAL}, k_init={INIT_K}, k_max={MAX_K}")
+    for dtype in (np.float64, np.float32):
+        res = bench_turns(dtype=dtype)
+        print(
+            f"{np.dtype(dtype).name:8s} | k={res['k']:2d} | "
+            f"{res['us_per_turn']:7.1f} us/turn | "
+            f"transient sample {res['sample_bytes']:5.0f} B + update {res['update_bytes']:5.0f} B | "
+            f"{res['bytes_per_aligner']:6d} B/aligner"
+        )
+
+    res = bench_batch()
+    print(
+        f"\n批量反馈 10000 条：逐条 {res['seq_ms']:.1f} ms vs 批量 {res['batch_ms']:.2f} ms，"
+        f"θ 最大差 {res['max_theta_diff']:.2e}"
+    )
+
+    print(f"\n子空间压缩 vs 直接调大 k_max（D={D_REAL}）：")
+    configs = [
+        (MAX_K, None),
+        (MAX_K, COMPACT_K),
+        (2 * MAX_K, None),
+        (D_REAL, None),
+    ]
+    for k_max, compact_to in configs:
+        res = bench_compaction(k_max, compact_to)
+        label = f"k_max={k_max}" + (f", compact_to={compact_to}" if compact_to else "")
+        print(
+            f"{label:26s} | cos={res['cos']:.4f} | "
+            f"{res['us_per_turn']:6.1f} us/turn | final k≈{res['final_k']:.1f}"
+        )
+
+    print("\n群体模型热启动：")
+    res = bench_population()
+    pop = res["pop"]
+    print(
+        f"N={len(pop)} | upsert {res['insert_us']:.1f} us/次 | refresh {res['refresh_s']:.2f} s | "
+        f"lookup p50 {res['lookup_p50_us']:.0f} us, p99 {res['lookup_p99_us']:.0f} us"
+    )
+    new_users = synthetic_population(20, draw_seed=1)  # 同一批主流风格下的新用户
+    rng = np.random.default_rng(SEED + 1)
+    for label, warm, noisy_query in (("冷启动", False, False), ("群体先验", True, False), ("带线索查近邻", True, True)):
+        hits = []
+        for i, w in enumerate(new_users):
+            query = None
+            if noisy_query:
+                # 模拟有一点点线索（如其他产品的反馈），与真实偏好只是粗略相关
+                query = w + 0.8 * rng.normal(0, 1, size=D_REAL) / np.sqrt(D_REAL)
+            hits.append(turns_to_target_warm(pop, w, SEED + i, warm, query))
+        reached = [h for h in hits if h is not None]
+        median = f"{np.median(reached):5.0f}" if reached else "  ---"
+        print(f"{label:8s} | 达标 {len(reached):2d}/{len(hits)} | 达到 cos ≥ {TARGET_COS} 的轮数中位数 {median}")
+
+
+    print(f"\n高维（float32，{len(SCALE_DIMS)} 档 D × k_max）：")
+    for D in SCALE_DIMS:
+        for k_max in (MAX_K, 64):
+            if k_max > D:
+                continue
+            res = bench_turns(dtype=np.float32, steps=1000, expand_every=10, D=D, k_max=k_max)
+            print(
+                f"D={D:5d} k_max={k_max:3d} | k={res['k']:2d} | {res['us_per_turn']:7.1f} us/turn | "
+                f"transient sample {res['sample_bytes']:6.0f} B + update {res['update_bytes']:5.0f} B | "
+                f"{res['bytes_per_aligner'] / 1024:7.1f} KiB/aligner | "
+                f"style_code {compress_action(np.ones(D)).size} 维"
+            )
+    for D in SCALE_DIMS[1:]:
+        res = bench_convergence_at_scale(D)
+        print(
+            f"D={D:5d} 收敛 | 群体索引构建 {res['build_s']:.1f} s | "
+            + " | ".join(
+                f"{label} 达标 {n:2d}/20 中位数 {'---' if med is None else f'{med:.0f}'}"
+                for label, (n, med) in (("冷启动", res["cold"]), ("热启动", res["warm"]))
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
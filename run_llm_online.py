@@ -3,12 +3,14 @@ import os
 
 import numpy as np
 
+from llm_bridge import LLM_BACKEND
 from session_core import ConversationSession
 
 
 def main():
-    if not os.getenv("OPENAI_API_KEY"):
-        print("请先在环境变量中设置 OPENAI_API_KEY。")
+    needs_key = LLM_BACKEND in ("openai", "record")
+    if needs_key and not (os.getenv("DEEPSEEK_API_KEY") or os.getenv("OPENAI_API_KEY")):
+        print("请先在环境变量中设置 DEEPSEEK_API_KEY（或 OPENAI_API_KEY），或用 LLM_BACKEND=synthetic 离线运行。")
         return
 
     session = ConversationSession()
@@ -0,0 +1,145 @@
+# run_replay.py
+"""
+离线回放一段时间内的真实流量：
+- 用户消息来自日志库（log_store），按原始时间间隔 / speed 依次送进 ConversationSession
+- LLM 走回放 / 合成后端，不联网、不花钱
+- 回放产生的日志写到单独的库，不污染线上日志
+
+例：python run_replay.py --start 2024-06-01T00:00 --end 2024-06-02T00:00 --speed 100 \
+        --record logs/llm_records.jsonl.gz
+"""
+import argparse
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from config import D_REAL, POP_BASIS, POP_CLUSTERS, SYNTH_LATENCY
+from llm_backends import ReplayBackend, SyntheticBackend
+from llm_bridge import LLMBridge
+from log_store import LogStore, default_log_store
+from population import PopulationIndex
+from session_core import ConversationSession
+
+
+def parse_time(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+
+
+def entry_epoch(entry: Dict) -> float:
+    return datetime.fromisoformat(entry["ts"]).replace(tzinfo=timezone.utc).timestamp()
+
+
+def replay(
+    entries: List[Dict],
+    bridge: LLMBridge,
+    out_store: LogStore,
+    speed: float,
+    workers: int,
+) -> Dict:
+    """
+    按时间顺序调度；不同会话并行，同一会话的消息串行且保持原始顺序：
+    会话按 id 哈希固定到一个单线程队列上，队列先进先出
+    """
+    population = PopulationIndex(D_REAL, n_basis=POP_BASIS, n_clusters=POP_CLUSTERS)
+    sessions: Dict[str, ConversationSession] = {}
+    registry_lock = threading.Lock()
+    latencies: List[float] = []
+    errors: List[str] = []
+
+    def run_turn(entry: Dict) -> None:
+        sid = entry["session_id"]
+        with registry_lock:
+            session = sessions.get(sid)
+            if session is None:
+                session = ConversationSession(
+                    session_id=sid, population=population, log_store=out_store, bridge=bridge
+                )
+                sessions[sid] = session
+        t0 = time.perf_counter()
+        try:
+            session.handle_message(entry["user"])
+        except Exception as exc:  # 回放要跑完整段流量，单轮失败只记录
+            errors.append(f"{sid}: {exc!r}")
+            return
+        latencies.append(time.perf_counter() - t0)
+
+    lanes = [ThreadPoolExecutor(max_workers=1) for _ in range(max(1, workers))]
+    origin = entry_epoch(entries[0]) if entries else 0.0
+    started = time.perf_counter()
+    try:
+        for entry in entries:
+            delay = (entry_epoch(entry) - origin) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            lane = zlib.crc32(entry["session_id"].encode("utf-8")) % len(lanes)
+            lanes[lane].submit(run_turn, entry)
+    finally:
+        for lane in lanes:
+            lane.shutdown(wait=True)
+    wall = time.perf_counter() - started
+    out_store.flush()
+
+    lat_ms = np.array(latencies) * 1e3
+    return {
+        "turns": len(latencies),
+        "sessions": len(sessions),
+        "errors": errors,
+        "wall_s": wall,
+        "traffic_s": (entry_epoch(entries[-1]) - origin) if entries else 0.0,
+        "p50_ms": float(np.percentile(lat_ms, 50)) if len(lat_ms) else None,
+        "p99_ms": float(np.percentile(lat_ms, 99)) if len(lat_ms) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放日志库里一段时间的真实流量")
+    parser.add_argument("--start", type=parse_time, default=None, help="unix 秒或 ISO 时间（UTC）")
+    parser.add_argument("--end", type=parse_time, default=None)
+    parser.add_argument("--db", default=None, help="读取的日志库，默认 logs/turns.db")
+    parser.add_argument("--out-db", default=str(Path(__file__).resolve().parent / "logs" / "replay.db"))
+    parser.add_argument("--record", default=None, help="LLM 录制文件；不给就全部用合成后端")
+    parser.add_argument("--latency", default=SYNTH_LATENCY, help="合成后端的延迟分布，见 llm_backends.parse_latency")
+    parser.add_argument("--speed", type=float, default=1.0, help="加速倍数，同时作用于流量间隔和 LLM 延迟")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    source = LogStore(args.db) if args.db else default_log_store()
+    entries = [e for e in source.range_logs(args.start, args.end) if e.get("user")]
+    if not entries:
+        print("这段时间没有可回放的用户消息。")
+        return
+
+    synthetic = SyntheticBackend(args.latency, speed=args.speed)
+    backend = ReplayBackend(args.record, speed=args.speed, fallback=synthetic) if args.record else synthetic
+    bridge = LLMBridge(backend=backend)
+    out_store = LogStore(args.out_db)
+
+    print(f"回放 {len(entries)} 轮消息，加速 {args.speed:g} 倍，LLM 后端 {type(backend).__name__}")
+    res = replay(entries, bridge, out_store, args.speed, args.workers)
+    summary = (
+        f"完成 {res['turns']} 轮 / {res['sessions']} 个会话 | "
+        f"原始时长 {res['traffic_s']:.0f} s → 回放 {res['wall_s']:.1f} s"
+    )
+    if res["turns"]:
+        summary += f" | 每轮 p50 {res['p50_ms']:.1f} ms, p99 {res['p99_ms']:.1f} ms"
+    print(summary)
+    if isinstance(backend, ReplayBackend):
+        print(f"录制命中：{backend.hits}（共 {len(backend)} 条录制）")
+    if res["errors"]:
+        print(f"{len(res['errors'])} 轮失败，例如：{res['errors'][0]}")
+
+
+if __name__ == "__main__":
+    main()
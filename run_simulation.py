@@ -1,11 +1,12 @@
 # run_simulation.py
 import numpy as np
-from typing import List
+from typing import List, Optional, Tuple
 
 from config import (
     D_REAL,
     INIT_K,
     MAX_K,
+    COMPACT_K,
     NOISE_STD,
     LAMBDA_RIDGE,
     WINDOW,
@@ -13,33 +14,99 @@ from config import (
     T_STEPS,
     SEED,
     EXPLORE_PROB,
+    ACTION_STRATEGY,
+    POSTERIOR_SCALE,
+    UCB_BETA,
+    TARGET_COS,
+    ALIGNER_DTYPE,
 )
 from user_env import UserEnv
 from latent_aligner import LatentAligner
 
 
-def main():
-    rng = np.random.default_rng(SEED)
+STRATEGIES = ("random", "thompson", "ucb")
 
-    # 1. 真实用户（我们不知道他的 w_true）
-    user = UserEnv.random(dim=D_REAL, noise_std=NOISE_STD, rng=rng)
 
-    # 2. 对齐器：一开始认为只有 INIT_K 维
-    aligner = LatentAligner(
-        D=D_REAL,
+def cos_sim(u: np.ndarray, v: np.ndarray) -> float:
+    return float(np.dot(u, v) / (np.linalg.norm(u) * np.linalg.norm(v) + 1e-9))
+
+
+def make_aligner(
+    rng: np.random.Generator,
+    strategy: str = ACTION_STRATEGY,
+    D: int = D_REAL,
+    k_max: int = MAX_K,
+    dtype=ALIGNER_DTYPE,
+) -> LatentAligner:
+    return LatentAligner(
+        D=D,
         k_init=INIT_K,
-        k_max=MAX_K,
+        k_max=k_max,
         lam=LAMBDA_RIDGE,
         rng=rng,
         explore_prob=EXPLORE_PROB,
+        dtype=dtype,
+        strategy=strategy,
+        posterior_scale=POSTERIOR_SCALE,
+        ucb_beta=UCB_BETA,
     )
 
+
+def turns_to_target(strategy: str, seed: int) -> Tuple[Optional[int], float]:
+    """
+    用给定策略静默跑一遍模拟（升维规则与 main 相同），
+    返回第一次 cos(w_hat, w_true) >= TARGET_COS 的轮数（没达到为 None）和最终 cos。
+    """
+    np.random.seed(seed)  # UserEnv.step 的噪声走全局随机数
+    rng = np.random.default_rng(seed)
+    user = UserEnv.random(dim=D_REAL, noise_std=NOISE_STD, rng=rng)
+    aligner = make_aligner(rng, strategy)
+
+    recent_errors: List[float] = []
+    hit = None
+    cos = 0.0
+    for t in range(T_STEPS):
+        a = aligner.sample_action()
+        r = user.step(a)
+        e, _ = aligner.update_with_sample(a, r)
+        recent_errors.append(e)
+        if (t + 1) % WINDOW == 0 and (aligner.k < MAX_K or COMPACT_K is not None):
+            if np.mean(np.square(recent_errors[-WINDOW:])) > ERR_THRESH:
+                aligner.expand_subspace(compact_to=COMPACT_K)
+        cos = cos_sim(aligner.current_approx_pref(), user.true_pref())
+        if hit is None and cos >= TARGET_COS:
+            hit = t + 1
+    return hit, cos
+
+
+def compare_strategies(seeds: int = 20) -> None:
+    print(f"\n====== 行为选择策略对比（{seeds} 个随机种子，目标 cos ≥ {TARGET_COS}） ======")
+    for strategy in STRATEGIES:
+        results = [turns_to_target(strategy, SEED + s) for s in range(seeds)]
+        hits = [h for h, _ in results if h is not None]
+        median = f"{np.median(hits):5.0f}" if hits else "  ---"
+        print(
+            f"{strategy:8s} | 达标 {len(hits):2d}/{seeds} | "
+            f"达标轮数中位数 {median} | 最终 cos 均值 {np.mean([c for _, c in results]):.4f}"
+        )
+
+
+def main():
+    rng = np.random.default_rng(SEED)
+
+    # 1. 真实用户（我们不知道他的 w_true）
+    user = UserEnv.random(dim=D_REAL, noise_std=NOISE_STD, rng=rng)
+
+    # 2. 对齐器：一开始认为只有 INIT_K 维
+    aligner = make_aligner(rng)
+
     recent_errors: List[float] = []
     dim_events = []
+    target_step = None
 
     print(f"真实用户偏好向量 w_true（前 8 维）：")
     print(np.round(user.true_pref()[:8], 3))
-    print(f"\n初始子空间维度 k = {aligner.k}\n")
+    print(f"\n初始子空间维度 k = {aligner.k}，行为选择策略 = {aligner.strategy}\n")
 
     for t in range(T_STEPS):
         # 系统选择一个行为向量（可以理解为某种说话风格 embedding）
@@ -60,25 +127,31 @@ def main():
                 f"r={r:+.3f} r_hat={r_hat:+.3f} | e={e:+.3f} | MSE_50={mse_50:.4f}"
             )
 
-        # 每 WINDOW 步，检查要不要升维
-        if (t + 1) % WINDOW == 0 and aligner.k < MAX_K:
+        # 每 WINDOW 步，检查要不要升维（满 MAX_K 后先压缩再升维）
+        if (t + 1) % WINDOW == 0 and (aligner.k < MAX_K or COMPACT_K is not None):
             window_err = np.mean(np.square(recent_errors[-WINDOW:]))
             if window_err > ERR_THRESH:
                 before_k = aligner.k
-                expanded = aligner.expand_subspace()
+                expanded = aligner.expand_subspace(compact_to=COMPACT_K)
                 if expanded:
                     dim_events.append((t + 1, aligner.k))
-                    print(
-                        f"  >>> step {t+1}: 近期误差 {window_err:.4f} 偏大，"
-                        f"从残差中挖出一条新方向，子空间升维 {before_k} -> {aligner.k}"
-                    )
+                    if aligner.k <= before_k:
+                        print(
+                            f"  >>> step {t+1}: 近期误差 {window_err:.4f} 偏大，子空间已满，"
+                            f"先压缩到 {COMPACT_K} 维再挖新方向 {before_k} -> {aligner.k}"
+                        )
+                    else:
+                        print(
+                            f"  >>> step {t+1}: 近期误差 {window_err:.4f} 偏大，"
+                            f"从残差中挖出一条新方向，子空间升维 {before_k} -> {aligner.k}"
+                        )
+
+        if target_step is None and cos_sim(aligner.current_approx_pref(), user.true_pref()) >= TARGET_COS:
+            target_step = t + 1
 
     # 最后看一下：最终逼近效果如何
     w_hat = aligner.current_approx_pref()
-    cos_sim = float(
-        np.dot(w_hat, user.true_pref())
-        / (np.linalg.norm(w_hat) * np.linalg.norm(user.true_pref()) + 1e-9)
-    )
+    final_cos = cos_sim(w_hat, user.true_pref())
 
     print("\n====== 结果小结 ======")
     print(f"最终子空间维度 k = {aligner.k}")
@@ -93,7 +166,13 @@ def main():
     print(np.round(w_hat[:8], 3))
     print("\n真实 w_true（前 8 维）以作对比：")
     print(np.round(user.true_pref()[:8], 3))
-    print(f"\ncosine 相似度 ≈ {cos_sim:.4f}")
+    print(f"\ncosine 相似度 ≈ {final_cos:.4f}")
+    if target_step is not None:
+        print(f"第 {target_step} 轮首次达到 cos ≥ {TARGET_COS}")
+    else:
+        print(f"{T_STEPS} 轮内未达到 cos ≥ {TARGET_COS}")
+
+    compare_strategies()
 
 
 if __name__ == "__main__":
@@ -3,9 +3,10 @@ from __future__ import annotations
 
 import json
 import os
-from datetime import datetime
-from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+import uuid
+from collections import deque
+from contextlib import nullcontext
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
 
 import numpy as np
 
@@ -13,21 +14,61 @@ from config import (
     D_REAL,
     INIT_K,
     MAX_K,
+    COMPACT_K,
     LAMBDA_RIDGE,
     WINDOW,
     SEED,
     EXPLORE_PROB,
+    ACTION_STRATEGY,
+    POSTERIOR_SCALE,
+    UCB_BETA,
+    ALIGNER_DTYPE,
     RESIDUAL_NORM_THRESH,
     BAD_MEAN_THRESH,
+    WARM_START_K,
 )
+from aligner_arena import AlignerArena
 from latent_aligner import LatentAligner
 from llm_bridge import LLMBridge
+from log_store import LogStore, default_log_store
+from population import PopulationIndex
+from profiler import profiler
+
+
+class _RollingWindow:
+    """固定长度滑动窗口，维护运行和，push / mean 都是 O(1)。"""
+
+    def __init__(self, size: int) -> None:
+        self.values: deque = deque(maxlen=size)
+        self.total = 0.0
+
+    def push(self, value: float) -> None:
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+
+    def full(self) -> bool:
+        return len(self.values) == self.values.maxlen
+
+    def mean(self) -> float:
+        return self.total / len(self.values) if self.values else 0.0
 
 
 class ConversationSession:
     """Stateful wrapper around LatentAligner + LLMBridge."""
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        session_id: Optional[str] = None,
+        population: Optional[PopulationIndex] = None,
+        log_store: Optional[LogStore] = None,
+        arena: Optional[AlignerArena] = None,
+        bridge: Optional[LLMBridge] = None,
+    ) -> None:
+        self.session_id = session_id or uuid.uuid4().hex
+        self.population = population
+        self.arena = arena
         rng = np.random.default_rng(SEED)
         self.aligner = LatentAligner(
             D=D_REAL,
@@ -36,20 +77,47 @@ class ConversationSession:
             lam=LAMBDA_RIDGE,
             rng=rng,
             explore_prob=EXPLORE_PROB,
+            strategy=ACTION_STRATEGY,
+            posterior_scale=POSTERIOR_SCALE,
+            ucb_beta=UCB_BETA,
+            dtype=ALIGNER_DTYPE,
         )
-        self.bridge = LLMBridge()
+        # 有 arena 时，对齐器状态和待评估的 action 都放在共享槽位里，任何 worker 都能接着处理这个会话
+        self._arena_slot: Optional[int] = None
+        self._arena_views: Optional[Dict[str, np.ndarray]] = None
+        self._pending_action: Optional[np.ndarray] = None
+        created = True
+        if arena is not None:
+            self._arena_slot, created = arena.attach(self.aligner, self.session_id)
+            self._arena_views = arena.arrays(self._arena_slot)
+        # 有群体模型时，用老用户自己存过的偏好（或群体均值）热启动 B 和 θ；
+        # arena 里已有的会话直接沿用共享状态
+        self.warm_started = False
+        # 热启动用的先验偏好（ridge 的收缩中心，None 表示 0）；
+        # 新用户学够 WINDOW 轮后再用自己的估计去群体索引里查一次近邻，把先验换成近邻均值
+        self._prior: Optional[np.ndarray] = None
+        self._refine_prior = False
+        if population is not None and created:
+            own = population.get(self.session_id)
+            self._prior = own if own is not None else population.lookup()
+            self._refine_prior = own is None
+            with self._state_lock():
+                self.warm_started = population.warm_start(self.aligner, k=WARM_START_K, prior=self._prior)
+        self.bridge = bridge or LLMBridge()
         self.conversation: List[Tuple[str, str]] = []
         self.recent_errors: List[float] = []
         self.reward_history: List[float] = []
         self.dim_events: List[Dict[str, Any]] = []
-        self.pending_action: Optional[np.ndarray] = None
         self.turn = 0
 
-        log_dir = Path(__file__).resolve().parent / "logs"
-        log_dir.mkdir(parents=True, exist_ok=True)
-        ts_label = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        self.log_file = log_dir / f"session_{ts_label}.log"
-        self._prune_logs(log_dir, keep=10)
+        # stats() / snapshot() 的增量维护与缓存：状态版本不变就直接复用
+        self._err_sq_window = _RollingWindow(WINDOW)
+        self._reward_window = _RollingWindow(WINDOW)
+        self._version = 0
+        self._stats_cache: Optional[Tuple[Tuple[int, int], Dict]] = None
+        self._snapshot_cache: Optional[Tuple[Tuple[int, int], Dict, str]] = None
+
+        self.log_store = log_store or default_log_store()
         self.total_tokens = {
             "reply": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
             "reward": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
@@ -61,17 +129,53 @@ class ConversationSession:
         self.style_hint = ""
 
     # ----------------------------- helpers ---------------------------------
+    def _state_lock(self) -> ContextManager:
+        """修改对齐器状态时持有的锁：arena 槽位锁（跨进程），没有 arena 时为空。"""
+        if self.arena is None:
+            return nullcontext()
+        return self.arena.lock(self._arena_slot)
+
+    @property
+    def pending_action(self) -> Optional[np.ndarray]:
+        """上一轮回复用的 action，等下一条用户消息来估计 reward。"""
+        if self._arena_views is None:
+            return self._pending_action
+        if not self._arena_views["_meta"][2]:
+            return None
+        return self._arena_views["pending"].copy()
+
+    @pending_action.setter
+    def pending_action(self, value: Optional[np.ndarray]) -> None:
+        if self._arena_views is None:
+            self._pending_action = value
+            return
+        if value is not None:
+            self._arena_views["pending"][:] = value
+        self._arena_views["_meta"][2] = value is not None
+
+    def _state_key(self) -> Tuple[int, int]:
+        return (self._version, self.aligner.version)
+
     def stats(self) -> Dict:
-        w_hat = self.aligner.current_approx_pref()
+        """按状态版本缓存；返回的字典是共享的，调用方不要修改。"""
+        key = self._state_key()
+        if self._stats_cache is None or self._stats_cache[0] != key:
+            self._stats_cache = (key, self._build_stats())
+        return self._stats_cache[1]
+
+    def _build_stats(self) -> Dict:
+        with self._state_lock():
+            w_hat = self.aligner.current_approx_pref()
+            current_k = self.aligner.k
         return {
             "turn": self.turn,
-            "current_k": self.aligner.k,
+            "current_k": current_k,
             "reward_history": self.reward_history[-100:],
-            "recent_mse": float(np.mean(np.square(self.recent_errors[-WINDOW:])))
-            if len(self.recent_errors) >= WINDOW
+            "recent_mse": self._err_sq_window.mean()
+            if self._err_sq_window.full()
             else None,
             "dim_events": [event.copy() for event in self.dim_events[-20:]],
-            "w_hat_preview": list(np.round(w_hat[:8], 3)),
+            "w_hat_preview": [round(float(v), 3) for v in w_hat[:8]],
             "token_stats": {
                 "total": {k: v.copy() for k, v in self.total_tokens.items()},
                 "last": {k: v.copy() for k, v in self.last_tokens.items()},
@@ -96,36 +200,43 @@ class ConversationSession:
             target_last[token_type] = value
 
     def _write_log(self, payload: Dict) -> None:
-        entry = {
-            "ts": datetime.utcnow().isoformat(),
-            **payload,
-        }
-        with self.log_file.open("a", encoding="utf-8") as fh:
-            fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.log_store.append(self.session_id, payload)
 
-    @staticmethod
-    def _prune_logs(log_dir: Path, keep: int) -> None:
-        logs = sorted(log_dir.glob("session_*.log"))
-        if len(logs) <= keep:
+    def _maybe_refine_prior(self) -> None:
+        """
+        新用户学够 WINDOW 轮后，用当前偏好估计查群体索引的近邻，
+        把 ridge 的收缩中心从群体均值挪到近邻均值（只做一次，要在写回群体模型之前，免得查到自己）
+        """
+        if not self._refine_prior or len(self.reward_history) < WINDOW:
             return
-        for stale in logs[:-keep]:
-            try:
-                stale.unlink()
-            except OSError:
-                pass
+        self._refine_prior = False
+        with self._state_lock():
+            neighbors = self.population.lookup(self.aligner.current_approx_pref())
+            if neighbors is None:
+                return
+            self.aligner.shift_prior(neighbors - self._prior if self._prior is not None else neighbors)
+        self._prior = neighbors
+
+    def _publish_pref(self, force: bool = False) -> None:
+        """学够 WINDOW 轮后，把当前偏好写回群体模型，供后续新会话热启动。"""
+        if self.population is None:
+            return
+        if not force and len(self.reward_history) < WINDOW:
+            return
+        with self._state_lock():
+            self.population.add_aligner(self.session_id, self.aligner)
 
     def _maybe_expand(self, turn_index: int) -> Optional[Dict[str, object]]:
-        """Expand子空间仅在 reward 长期偏低且残差信号强时触发。"""
-        if self.aligner.k >= MAX_K:
+        """Expand子空间仅在 reward 长期偏低且残差信号强时触发；满 MAX_K 时先压缩再升维。"""
+        if self.aligner.k >= MAX_K and COMPACT_K is None:
             return None
 
         residual_norm = float(np.linalg.norm(self.aligner.grad_residual))
 
-        if len(self.reward_history) < WINDOW:
+        if not self._reward_window.full():
             return None
 
-        recent_rewards = self.reward_history[-WINDOW:]
-        mean_reward = float(np.mean(recent_rewards))
+        mean_reward = self._reward_window.mean()
 
         should_expand = (
             mean_reward < BAD_MEAN_THRESH
@@ -138,7 +249,10 @@ class ConversationSession:
             return None
 
         before_k = self.aligner.k
-        expanded = self.aligner.expand_subspace(min_norm=RESIDUAL_NORM_THRESH)
+        expanded = self.aligner.expand_subspace(
+            min_norm=RESIDUAL_NORM_THRESH, compact_to=COMPACT_K
+        )
+        compacted = expanded and self.aligner.k <= before_k
         reason.setdefault("mean_reward", mean_reward)
         reason.setdefault("residual_norm", residual_norm)
         reason["previous_k"] = before_k
@@ -152,30 +266,56 @@ class ConversationSession:
                     "new_k": self.aligner.k,
                     "mean_reward": mean_reward,
                     "residual_norm": residual_norm,
+                    "compacted": compacted,
                 }
             )
             reason["expanded"] = True
+            reason["compacted"] = compacted
         else:
             reason["expanded"] = False
         return reason
 
     # ----------------------------- main API --------------------------------
     def handle_message(self, user_msg: str) -> Dict:
+        with profiler.turn(self.session_id, self.turn + 1):
+            return self._handle_message(user_msg)
+
+    def _stage(self, name: str) -> ContextManager:
+        """给 profiler 标记本轮当前所处的阶段。"""
+        return profiler.stage(self.session_id, name)
+
+    def _handle_message(self, user_msg: str) -> Dict:
         debug_info: Dict = {}
 
         # 1) 如果有上一轮的 action，用本次自然输入估计 reward
-        if self.pending_action is not None:
-            reward, reward_usage, hard_flags = self.bridge.estimate_reward(
-                self.conversation, user_msg
-            )
+        # LLM 调用期间不持有状态锁，只在读写对齐器时加锁；
+        # 取出 pending 和清掉它在同一次加锁里完成，两个 worker 不会拿同一个 action 各更新一次；
+        # reward 估计失败时再放回去（期间没有别人写入新的），下一条消息还能重试
+        with self._state_lock():
+            pending = self.pending_action
+            self.pending_action = None
+        if pending is not None:
+            try:
+                with self._stage("reward_llm"):
+                    reward, reward_usage, hard_flags = self.bridge.estimate_reward(
+                        self.conversation, user_msg
+                    )
+            except Exception:
+                with self._state_lock():
+                    if self.pending_action is None:
+                        self.pending_action = pending
+                raise
             soft_reward = reward
             if "forbid_parentheses" in hard_flags:
                 soft_reward = 0.0
 
-            e, r_hat = self.aligner.update_with_sample(self.pending_action, soft_reward)
+            with self._stage("update"), self._state_lock():
+                e, r_hat = self.aligner.update_with_sample(pending, soft_reward)
             # recent_errors 现在记录 reward/advantage 信号，而非预测误差
             self.recent_errors.append(e)
             self.reward_history.append(reward)
+            self._err_sq_window.push(e * e)
+            self._reward_window.push(reward)
             debug_info.update(
                 {
                     "reward": reward,
@@ -187,6 +327,9 @@ class ConversationSession:
             )
 
             self._accumulate_tokens("reward", reward_usage)
+            with self._stage("population"):
+                self._maybe_refine_prior()
+                self._publish_pref()
 
             if reward < 0:
                 self.style_hint = f"上一轮用户不满，抱怨内容：{user_msg[:200]}"
@@ -195,51 +338,98 @@ class ConversationSession:
             else:
                 self.style_hint = ""
 
-            expand_info = self._maybe_expand(self.turn)
+            with self._stage("expand"), self._state_lock():
+                expand_info = self._maybe_expand(self.turn)
             if expand_info:
                 debug_info["dim_update"] = expand_info
 
         # 2) 当前输入触发新的回复
-        action_vec = self.aligner.sample_action()
-        reply, reply_usage = self.bridge.generate_reply(
-            action_vec,
-            self.conversation,
-            user_msg,
-            style_hint=self.style_hint,
-        )
+        with self._stage("sample"), self._state_lock():
+            action_vec = self.aligner.sample_action()
+        with self._stage("reply_llm"):
+            reply, reply_usage = self.bridge.generate_reply(
+                action_vec,
+                self.conversation,
+                user_msg,
+                style_hint=self.style_hint,
+            )
         self.conversation.append(("user", user_msg))
         self.conversation.append(("assistant", reply))
         self._accumulate_tokens("reply", reply_usage)
 
-        self.pending_action = action_vec
+        with self._state_lock():
+            self.pending_action = action_vec
         self.turn += 1
+        self._version += 1
+
+        with self._stage("log"):
+            self._write_log(
+                {
+                    "turn": self.turn,
+                    "user": user_msg,
+                    "assistant": reply,
+                    "reward": debug_info.get("reward"),
+                    "prediction": debug_info.get("prediction"),
+                    "error": debug_info.get("error"),
+                    "k": self.aligner.k,
+                    "tokens": {
+                        "last": {k: v.copy() for k, v in self.last_tokens.items()},
+                        "total": {k: v.copy() for k, v in self.total_tokens.items()},
+                    },
+                    "style_hint": self.style_hint,
+                }
+            )
+
+        with self._stage("stats"):
+            stats = self.stats()
+        return {
+            "assistant_reply": reply,
+            "debug": debug_info,
+            "stats": stats,
+            "conversation": self.conversation_tail(),
+        }
 
+    def ingest_feedback(self, actions: np.ndarray, rewards: np.ndarray) -> Dict:
+        """
+        批量吸收离线反馈（A/B 日志、其他产品的点赞/点踩等），只更新对齐器，不算对话轮次；
+        rewards 与 estimate_reward 一样裁剪到 [-1, 1]，含 NaN / inf 时整批拒绝
+        """
+        rewards = np.asarray(rewards, dtype=float)
+        if not np.isfinite(rewards).all():
+            raise ValueError("rewards 含 NaN 或 inf")
+        rewards = np.clip(rewards, -1.0, 1.0)
+        with self._state_lock():
+            signal, r_hat = self.aligner.update_with_batch(actions, rewards)
+        self._version += 1
+        self._publish_pref(force=True)
         self._write_log(
             {
                 "turn": self.turn,
-                "user": user_msg,
-                "assistant": reply,
-                "reward": debug_info.get("reward"),
-                "prediction": debug_info.get("prediction"),
-                "error": debug_info.get("error"),
+                "feedback_samples": int(len(r_hat)),
+                "feedback_mean_reward": float(np.mean(signal)) if len(r_hat) else None,
                 "k": self.aligner.k,
-                "tokens": {
-                    "last": {k: v.copy() for k, v in self.last_tokens.items()},
-                    "total": {k: v.copy() for k, v in self.total_tokens.items()},
-                },
-                "style_hint": self.style_hint,
             }
         )
-
         return {
-            "assistant_reply": reply,
-            "debug": debug_info,
+            "session_id": self.session_id,
+            "samples": int(len(r_hat)),
             "stats": self.stats(),
-            "conversation": self.conversation_tail(),
         }
 
     def snapshot(self) -> Dict:
-        return {
-            "stats": self.stats(),
-            "conversation": self.conversation_tail(),
-        }
+        return self._cached_snapshot()[0]
+
+    def snapshot_json(self) -> str:
+        """snapshot() 的 JSON 序列化结果，按状态版本缓存，供轮询和广播直接复用。"""
+        return self._cached_snapshot()[1]
+
+    def _cached_snapshot(self) -> Tuple[Dict, str]:
+        key = self._state_key()
+        if self._snapshot_cache is None or self._snapshot_cache[0] != key:
+            snap = {
+                "session_id": self.session_id,
+                "stats": self.stats(),
+                "conversation": self.conversation_tail(),
+            }
+            self._snapshot_cache = (key, snap, json.dumps(snap, ensure_ascii=False))
+        return self._snapshot_cache[1], self._snapshot_cache[2]
@@ -17,17 +17,19 @@ class UserEnv:
     noise_std: float = 0.1
 
     @classmethod
-    def random(cls, dim: int, noise_std: float = 0.1, rng: np.random.Generator = None) -> "UserEnv":
+    def random(
+        cls, dim: int, noise_std: float = 0.1, rng: np.random.Generator = None, dtype=np.float64
+    ) -> "UserEnv":
+        """dtype 用 float32 时可与 float32 的对齐器直接做点积，高维下不用每轮转换精度"""
         rng = rng or np.random.default_rng()
         w = rng.normal(0, 1, size=dim)
         w /= np.linalg.norm(w) + 1e-9
-        return cls(w_true=w, noise_std=noise_std)
+        return cls(w_true=w.astype(dtype, copy=False), noise_std=noise_std)
 
     def step(self, action: np.ndarray) -> float:
         """给一个行为向量 action，返回用户的模糊反馈 r"""
-        action = action.astype(float)
-        action /= np.linalg.norm(action) + 1e-9
-        base = float(np.dot(self.w_true, action))
+        # <w, a/|a|> = <w, a>/|a|，不拷贝、不归一化 action 本身（高维时省掉一次 D 维分配）
+        base = float(np.dot(self.w_true, action)) / (float(np.linalg.norm(action)) + 1e-9)
         noise = float(np.random.normal(0, self.noise_std))
         return base + noise
 
@@ -1,17 +1,63 @@
 """FastAPI server that exposes the latent aligner conversation as a web API."""
+import asyncio
+import base64
+import hmac
+import logging
 import os
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Union
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import numpy as np
+from fastapi import Depends, FastAPI, Header, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
+from aligner_arena import AlignerArena
+from config import (
+    ALIGNER_DTYPE,
+    ARENA_PATH,
+    ARENA_SLOTS,
+    D_REAL,
+    MAX_K,
+    POP_BASIS,
+    POP_CLUSTERS,
+    POP_SYNC_SECONDS,
+    PUBSUB_BACKEND,
+    PUBSUB_COALESCE_MS,
+    PUBSUB_URL,
+    WINDOW,
+)
+from log_store import default_log_store
+from population import PopulationIndex
+from profiler import profiler
+from pubsub import CoalescingFanout, make_pubsub
 from session_core import ConversationSession
 
-session = ConversationSession()
-subscribers: List[WebSocket] = []
+population = PopulationIndex(D_REAL, n_basis=POP_BASIS, n_clusters=POP_CLUSTERS)
+# 多 worker 部署时所有进程映射同一个 arena，默认会话用固定 id，任何 worker 都能接着处理
+arena: Optional[AlignerArena] = (
+    AlignerArena(ARENA_PATH, D_REAL, MAX_K, n_slots=ARENA_SLOTS, dtype=ALIGNER_DTYPE)
+    if ARENA_PATH
+    else None
+)
+# 群体模型从 arena 里已学过 WINDOW 轮以上的会话构建，先于任何会话创建，新会话一开始就能热启动
+if arena is not None:
+    population.load(arena.prefs(min_version=WINDOW))
+session = ConversationSession(
+    session_id="default" if arena is not None else None,
+    population=population,
+    arena=arena,
+)
+sessions: Dict[str, ConversationSession] = {session.session_id: session}
+# 本 worker 的 WebSocket 订阅者 -> 关注的 session_id（"*" 表示全部）
+subscribers: Dict[WebSocket, str] = {}
+bus = make_pubsub(PUBSUB_BACKEND, PUBSUB_URL)
+# 发布可能有网络 I/O（redis），放到单独的线程里按顺序发，不阻塞事件循环
+publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pubsub-publish")
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Latent Aligner Web API")
 app.add_middleware(
@@ -23,20 +69,82 @@ app.add_middleware(
 )
 
 
-async def broadcast_snapshot():
-    """Push latest snapshot to all connected WebSocket clients."""
-    payload = session.snapshot()
+async def _send_to_subscribers(batch: Dict[str, str]) -> None:
+    """Deliver coalesced snapshots to this worker's WebSocket clients."""
     stale: List[WebSocket] = []
-    for ws in subscribers:
-        try:
-            await ws.send_json(payload)
-        except Exception:
-            stale.append(ws)
+    for ws, watched in list(subscribers.items()):
+        for session_id, payload in batch.items():
+            if watched not in ("*", session_id):
+                continue
+            try:
+                await ws.send_text(payload)
+            except Exception:
+                stale.append(ws)
+                break
     for ws in stale:
+        subscribers.pop(ws, None)
+
+
+fanout = CoalescingFanout(_send_to_subscribers, interval=PUBSUB_COALESCE_MS / 1000)
+bus.subscribe(fanout.offer)
+
+
+@app.on_event("startup")
+async def _start_fanout():
+    fanout.loop = asyncio.get_running_loop()
+    if arena is not None:
+        asyncio.get_running_loop().create_task(_sync_population())
+
+
+def _build_population() -> PopulationIndex:
+    fresh = PopulationIndex(D_REAL, n_basis=POP_BASIS, n_clusters=POP_CLUSTERS)
+    fresh.load(arena.prefs(min_version=WINDOW))
+    return fresh
+
+
+async def _sync_population():
+    """
+    定期从 arena 重建群体模型，各 worker 本地增量写入的差异在这里收敛到同一份存量状态；
+    逐槽位读取和 refresh（SVD + k-means）都在线程池里做，事件循环上只做最后的替换
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(POP_SYNC_SECONDS)
         try:
-            subscribers.remove(ws)
-        except ValueError:
-            pass
+            fresh = await loop.run_in_executor(None, _build_population)
+        except Exception:
+            logger.exception("syncing population from arena failed")
+            continue
+        population.adopt(fresh)
+
+
+@app.on_event("shutdown")
+async def _stop_fanout():
+    publisher.shutdown(wait=False)
+    bus.close()
+
+
+async def broadcast_snapshot(target: Optional[ConversationSession] = None):
+    """Publish the latest snapshot once; every worker fans it out to its own WebSocket clients."""
+    target = target or session
+    publisher.submit(_publish, target.session_id, target.snapshot_json())
+
+
+def _publish(session_id: str, payload: str) -> None:
+    # 这一轮已经生效，丢一次广播可以接受，不能因此让请求失败
+    try:
+        bus.publish(session_id, payload)
+    except Exception:
+        logger.exception("publishing state of session %s failed", session_id)
+
+
+def get_session(session_id: str) -> Optional[ConversationSession]:
+    """本进程已有的会话；不在本进程但 arena 里有时，就地挂上共享状态。"""
+    target = sessions.get(session_id)
+    if target is None and arena is not None and session_id in arena:
+        target = ConversationSession(session_id=session_id, population=population, arena=arena)
+        sessions[session_id] = target
+    return target
 
 
 class ChatRequest(BaseModel):
@@ -45,29 +153,150 @@ class ChatRequest(BaseModel):
 
 @app.post("/api/chat")
 async def api_chat(payload: ChatRequest):
-    resp = session.handle_message(payload.message.strip())
-    await broadcast_snapshot()
+    # broadcast 也算进这一轮，慢轮追踪和阶段耗时里能看到它
+    with profiler.turn(session.session_id, session.turn + 1):
+        resp = session.handle_message(payload.message.strip())
+        with profiler.stage(session.session_id, "broadcast"):
+            await broadcast_snapshot()
+    return resp
+
+
+class FeedbackRequest(BaseModel):
+    # 列表形式，或 base64 编码的小端 float32 紧凑数组（actions 按行展开）
+    actions: Union[str, List[List[float]]]
+    rewards: Union[str, List[float]]
+
+
+def _unpack_array(value: Union[str, list], cols: Optional[int] = None) -> np.ndarray:
+    if isinstance(value, str):
+        try:
+            raw = base64.b64decode(value, validate=True)
+        except ValueError as exc:
+            raise ValueError(f"invalid base64 payload: {exc}") from exc
+        if len(raw) % 4:
+            raise ValueError("packed array length is not a multiple of 4 bytes")
+        arr = np.frombuffer(raw, dtype="<f4")
+        if cols is not None:
+            if arr.size % cols:
+                raise ValueError(f"packed actions size {arr.size} is not a multiple of {cols}")
+            arr = arr.reshape(-1, cols)
+        return arr
+    return np.asarray(value, dtype=float)
+
+
+@app.post("/api/sessions/{session_id}/feedback")
+async def api_feedback(session_id: str, payload: FeedbackRequest):
+    target = get_session(session_id)
+    if target is None:
+        raise HTTPException(status_code=404, detail=f"unknown session {session_id}")
+    try:
+        actions = _unpack_array(payload.actions, cols=target.aligner.D)
+        rewards = _unpack_array(payload.rewards)
+        resp = target.ingest_feedback(actions, rewards)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    await broadcast_snapshot(target)
     return resp
 
 
+@app.get("/api/sessions/{session_id}/logs")
+def api_session_logs(
+    session_id: str,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    limit: Optional[int] = 500,
+):
+    """Turn log entries of one session, optionally within [start, end) unix seconds; the newest `limit`, oldest first."""
+    return default_log_store().session_logs(session_id, start=start, end=end, limit=limit)
+
+
+# ----------------------------- admin: profiling ---------------------------------
+# 设置了 LATENT_ADMIN_TOKEN 才开放，请求头 X-Admin-Token 需与之一致
+ADMIN_TOKEN = os.getenv("LATENT_ADMIN_TOKEN")
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="admin endpoints are disabled (set LATENT_ADMIN_TOKEN)")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+
+
+class ProfileRequest(BaseModel):
+    seconds: Optional[float] = Field(None, gt=0)
+    turns: Optional[int] = Field(None, gt=0)
+    interval_ms: Optional[float] = Field(None, gt=0)
+
+
+class SlowTurnRequest(BaseModel):
+    threshold_ms: float = Field(..., ge=0)
+
+
+@app.post("/api/admin/profile/start", dependencies=[Depends(require_admin)])
+def api_profile_start(payload: ProfileRequest):
+    """Sample every thread's stack until `seconds` elapse or `turns` turns finish (or stop is called)."""
+    if payload.seconds is None and payload.turns is None:
+        raise HTTPException(status_code=400, detail="give seconds or turns")
+    interval = payload.interval_ms / 1000 if payload.interval_ms is not None else None
+    try:
+        return profiler.start(seconds=payload.seconds, turns=payload.turns, interval=interval)
+    except RuntimeError as exc:
+        raise HTTPException(status_code=409, detail=str(exc)) from exc
+
+
+@app.post("/api/admin/profile/stop", dependencies=[Depends(require_admin)])
+def api_profile_stop():
+    return profiler.stop()
+
+
+@app.get("/api/admin/profile", dependencies=[Depends(require_admin)])
+def api_profile_result(top: int = 50, include_idle: bool = False, format: str = "json"):
+    """Aggregated samples so far; format=collapsed returns flamegraph.pl / speedscope input."""
+    result = profiler.result(top=top, include_idle=include_idle)
+    if format == "collapsed":
+        return Response(content=result["collapsed"], media_type="text/plain")
+    return result
+
+
+@app.post("/api/admin/profile/slow-turn", dependencies=[Depends(require_admin)])
+def api_slow_turn_arm(payload: SlowTurnRequest):
+    """Capture a full cProfile trace of the next turn slower than threshold_ms."""
+    profiler.arm_slow_turn(payload.threshold_ms)
+    return profiler.status()
+
+
+@app.delete("/api/admin/profile/slow-turn", dependencies=[Depends(require_admin)])
+def api_slow_turn_disarm():
+    profiler.disarm_slow_turn()
+    return profiler.status()
+
+
+@app.get("/api/admin/profile/slow-turn", dependencies=[Depends(require_admin)])
+def api_slow_turn_result():
+    return {"armed": profiler.status()["slow_turn_threshold_ms"] is not None, "trace": profiler.slow_turn}
+
+
 @app.get("/api/state")
 def api_state():
-    return session.snapshot()
+    return Response(content=session.snapshot_json(), media_type="application/json")
 
 
 @app.websocket("/ws/state")
-async def ws_state(websocket: WebSocket):
+async def ws_state(websocket: WebSocket, session_id: Optional[str] = None):
+    """Stream snapshots of one session (default: the dashboard session), or of all sessions with session_id=*."""
     await websocket.accept()
-    subscribers.append(websocket)
+    watched = session_id or session.session_id
+    subscribers[websocket] = watched
     try:
-        await websocket.send_json(session.snapshot())
+        initial = session if watched == "*" else get_session(watched)
+        if initial is not None:
+            await websocket.send_text(initial.snapshot_json())
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
         pass
     finally:
-        if websocket in subscribers:
-            subscribers.remove(websocket)
+        subscribers.pop(websocket, None)
 
 
 FRONTEND_DIR = os.path.join(os.path.dirname(__file__), "web_frontend")